@@ -0,0 +1,253 @@
+"""
+Cross-session analytics store: running aggregates per treatment, round and firm size.
+
+Both apps call `record_session(subsession)` once, when the payoffs of the final
+round are set. It adds that session's groups and players to running totals in
+a SQLite file, so treatment-level averages never need a re-export of earlier
+sessions, and reading them costs the same however many sessions there are.
+The store is off unless the env var PGG_ANALYTICS_DB=<file> is set. A session
+is counted once: recording the same session code again does nothing.
+
+The treatment is the session config name (so test and bot configs stay apart).
+Tables, keyed by (treatment, round_number, firm_size); firm size 1 is autarky:
+
+    sessions        session_code, treatment, num_players, recorded
+    size_stats      groups, players,
+                    effort_cents_sum, effort_cents_sumsq       per player
+                    payoff_cents_sum, payoff_cents_sumsq       per player
+                    per_capita_effort_sum, per_capita_effort_sumsq   per group
+    effort_hist     + effort (whole points, 0..endowment) -> players
+
+Mean and variance follow from count, sum and sum of squares; the autarky rate
+of a round is players at size 1 over all players. `summary()` does this per
+treatment and size over all rounds. From this directory:
+
+    PGG_ANALYTICS_DB=analytics.sqlite3 otree prodserver
+    python analytics.py analytics.sqlite3                 # every treatment
+    python analytics.py analytics.sqlite3 T3_endogenous_constant
+"""
+import argparse
+import logging
+import os
+import sqlite3
+import sys
+import time
+
+
+logger = logging.getLogger(__name__)
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS sessions (
+    session_code TEXT PRIMARY KEY,
+    treatment TEXT NOT NULL,
+    num_players INTEGER NOT NULL,
+    recorded REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS size_stats (
+    treatment TEXT NOT NULL,
+    round_number INTEGER NOT NULL,
+    firm_size INTEGER NOT NULL,
+    groups INTEGER NOT NULL,
+    players INTEGER NOT NULL,
+    effort_cents_sum INTEGER NOT NULL,
+    effort_cents_sumsq INTEGER NOT NULL,
+    payoff_cents_sum INTEGER NOT NULL,
+    payoff_cents_sumsq INTEGER NOT NULL,
+    per_capita_effort_sum REAL NOT NULL,
+    per_capita_effort_sumsq REAL NOT NULL,
+    PRIMARY KEY (treatment, round_number, firm_size)
+);
+CREATE TABLE IF NOT EXISTS effort_hist (
+    treatment TEXT NOT NULL,
+    round_number INTEGER NOT NULL,
+    firm_size INTEGER NOT NULL,
+    effort INTEGER NOT NULL,
+    players INTEGER NOT NULL,
+    PRIMARY KEY (treatment, round_number, firm_size, effort)
+);
+"""
+
+_ADD_SIZE_STATS = """
+INSERT INTO size_stats VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (treatment, round_number, firm_size) DO UPDATE SET
+    groups = groups + excluded.groups,
+    players = players + excluded.players,
+    effort_cents_sum = effort_cents_sum + excluded.effort_cents_sum,
+    effort_cents_sumsq = effort_cents_sumsq + excluded.effort_cents_sumsq,
+    payoff_cents_sum = payoff_cents_sum + excluded.payoff_cents_sum,
+    payoff_cents_sumsq = payoff_cents_sumsq + excluded.payoff_cents_sumsq,
+    per_capita_effort_sum = per_capita_effort_sum + excluded.per_capita_effort_sum,
+    per_capita_effort_sumsq = per_capita_effort_sumsq + excluded.per_capita_effort_sumsq
+"""
+
+_ADD_HIST = """
+INSERT INTO effort_hist VALUES (?, ?, ?, ?, ?)
+ON CONFLICT (treatment, round_number, firm_size, effort) DO UPDATE SET
+    players = players + excluded.players
+"""
+
+
+def connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    conn.executescript(SCHEMA)
+    return conn
+
+
+def record_session(subsession):
+    """Add the session of `subsession` (any round) to the store, if enabled."""
+    path = os.environ.get('PGG_ANALYTICS_DB')
+    if not path:
+        return
+    session = subsession.session
+    try:
+        add_session(path, session.code, session.config['name'], session_rows(subsession))
+    except sqlite3.Error as exc:
+        # the last round's payoffs must not fail over the analytics store
+        logger.warning(f"analytics: cannot record session {session.code} in {path}: {exc}")
+
+
+def session_rows(subsession):
+    """(round, firm size, group per_capita_effort, [(effort_cents, payoff_cents)]) per group."""
+    for s in subsession.in_all_rounds():
+        by_group = {}
+        for p in s.get_players():
+            by_group.setdefault(p.group, []).append((p.effort_cents, p.payoff_cents))
+        for group, players in by_group.items():
+            yield s.round_number, len(players), group.per_capita_effort, players
+
+
+def add_session(path, session_code, treatment, rows):
+    """Add one session's group rows in one transaction. Returns False if already recorded."""
+    stats = {}
+    hist = {}
+    for round_number, size, per_capita_effort, players in rows:
+        key = (round_number, size)
+        s = stats.setdefault(key, [0, 0, 0, 0, 0, 0, 0.0, 0.0])
+        s[0] += 1
+        s[1] += len(players)
+        for effort_cents, payoff_cents in players:
+            s[2] += effort_cents
+            s[3] += effort_cents ** 2
+            s[4] += payoff_cents
+            s[5] += payoff_cents ** 2
+            bin_key = key + (effort_cents // 100,)
+            hist[bin_key] = hist.get(bin_key, 0) + 1
+        s[6] += per_capita_effort
+        s[7] += per_capita_effort ** 2
+    num_players = sum(s[1] for (r, _), s in stats.items() if r == 1)
+
+    conn = connect(path)
+    try:
+        with conn:
+            added = conn.execute(
+                "INSERT OR IGNORE INTO sessions VALUES (?, ?, ?, ?)",
+                (session_code, treatment, num_players, time.time()),
+            ).rowcount
+            if not added:
+                return False
+            conn.executemany(_ADD_SIZE_STATS, [(treatment, *key, *s) for key, s in stats.items()])
+            conn.executemany(_ADD_HIST, [(treatment, *key, n) for key, n in hist.items()])
+        return True
+    finally:
+        conn.close()
+
+
+# ---------------------------
+# Queries
+# ---------------------------
+
+
+def _mean_sd(n, total, sumsq):
+    if not n:
+        return None, None
+    mean = total / n
+    var = max(0.0, sumsq / n - mean * mean)
+    return mean, var ** 0.5
+
+
+def summary(conn, treatment=None):
+    """Per treatment and firm size, over all rounds: shares, means and SDs (points)."""
+    where, params = ("WHERE treatment = ?", (treatment,)) if treatment else ("", ())
+    totals = dict(conn.execute(
+        f"SELECT treatment, SUM(players) FROM size_stats {where} GROUP BY treatment", params))
+    out = []
+    for row in conn.execute(
+        f"SELECT treatment, firm_size, SUM(groups), SUM(players),"
+        f" SUM(effort_cents_sum), SUM(effort_cents_sumsq),"
+        f" SUM(payoff_cents_sum), SUM(payoff_cents_sumsq),"
+        f" SUM(per_capita_effort_sum), SUM(per_capita_effort_sumsq)"
+        f" FROM size_stats {where} GROUP BY treatment, firm_size ORDER BY treatment, firm_size",
+        params,
+    ):
+        treatment_, size, groups, players, e, e2, pay, pay2, pce, pce2 = row
+        effort_mean, effort_sd = _mean_sd(players, e, e2)
+        payoff_mean, payoff_sd = _mean_sd(players, pay, pay2)
+        pce_mean, pce_sd = _mean_sd(groups, pce, pce2)
+        out.append(dict(
+            treatment=treatment_,
+            firm_size=size,
+            groups=groups,
+            players=players,
+            player_share=players / totals[treatment_],
+            effort_mean=effort_mean / 100,
+            effort_sd=effort_sd / 100,
+            payoff_mean=payoff_mean / 100,
+            payoff_sd=payoff_sd / 100,
+            per_capita_effort_mean=pce_mean,
+            per_capita_effort_sd=pce_sd,
+        ))
+    return out
+
+
+def autarky_rates(conn, treatment):
+    """{round_number: share of players in autarky (firm size 1)}."""
+    return {
+        round_number: autarkic / players
+        for round_number, autarkic, players in conn.execute(
+            "SELECT round_number, SUM(CASE WHEN firm_size = 1 THEN players ELSE 0 END), SUM(players)"
+            " FROM size_stats WHERE treatment = ? GROUP BY round_number ORDER BY round_number",
+            (treatment,),
+        )
+    }
+
+
+def effort_histogram(conn, treatment, firm_size=None):
+    """{effort in whole points: players}, over all rounds (and sizes, unless given)."""
+    sql = "SELECT effort, SUM(players) FROM effort_hist WHERE treatment = ?"
+    params = [treatment]
+    if firm_size is not None:
+        sql += " AND firm_size = ?"
+        params.append(firm_size)
+    return dict(conn.execute(sql + " GROUP BY effort ORDER BY effort", params))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('db', help="the analytics SQLite file (PGG_ANALYTICS_DB)")
+    parser.add_argument('treatment', nargs='?', help="session config name (default: all)")
+    args = parser.parse_args()
+
+    conn = connect(args.db)
+    sessions = dict(conn.execute("SELECT treatment, COUNT(*) FROM sessions GROUP BY treatment"))
+    rows = summary(conn, args.treatment)
+    if not rows:
+        print("no sessions recorded")
+        return 1
+    print(f"  {'treatment':<26}{'size':>5}{'groups':>8}{'share':>7}"
+          f"{'effort':>8}{'sd':>6}{'pc effort':>10}{'payoff':>8}")
+    print('-' * 78)
+    for r in rows:
+        print(f"  {r['treatment']:<26}{r['firm_size']:>5}{r['groups']:>8}{r['player_share']:>7.2f}"
+              f"{r['effort_mean']:>8.2f}{r['effort_sd']:>6.2f}{r['per_capita_effort_mean']:>10.2f}"
+              f"{r['payoff_mean']:>8.2f}")
+    print()
+    for treatment, n in sorted(sessions.items()):
+        if not args.treatment or treatment == args.treatment:
+            rates = autarky_rates(conn, treatment)
+            mean_rate = sum(rates.values()) / len(rates) if rates else 0
+            print(f"  {treatment}: {n} session(s), mean autarky rate {mean_rate:.2f}")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,418 @@
+"""
+Capacity benchmark: how one oTree server process behaves as sessions pile up.
+
+Starts a local server on a scratch SQLite database, then adds sessions one at a
+time (cycling through the chosen configs from settings.SESSION_CONFIGS) and
+drives every participant with a scripted client that clicks through the pages,
+submits a random effort on Decision and, on Formation, applies/accepts/probes
+over the live websocket for a few seconds before moving on. After each added
+session it measures for a fixed window and reports, per number of concurrent
+sessions K:
+
+- event-loop lag: latency of a trivial static-file request, minus the same
+  request's median latency on the idle server
+- live latency: round trip of a live_formation message answered only to the
+  sender (a rejected self-application, so it exercises the full handler)
+- DB contention: latency of page submissions (each one is a write transaction)
+- throughput (pages/s) and HTTP/websocket errors
+
+Usage, from this directory:
+
+    python bench_capacity.py                         # 4 sessions, all full-size configs
+    python bench_capacity.py --sessions 6 --window 45 --json cap.json
+    python bench_capacity.py --configs T1_exogenous_constant,T3_endogenous_constant
+    python bench_capacity.py --url http://127.0.0.1:8000  # existing server
+
+Clients run in this process, so for large K run the benchmark on a separate
+machine with --url to keep client CPU out of the measurements. Against a server
+with OTREE_AUTH_LEVEL set, export OTREE_REST_KEY as well.
+
+Needs requests and websockets: pip install -r requirements_analysis.txt
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import re
+import signal
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+try:
+    import requests
+    import websockets
+except ImportError as e:
+    raise Exception(f"bench_capacity.py needs {e.name}: pip install -r requirements_analysis.txt")
+
+import settings
+
+
+PAGE_PATH = re.compile(r'/p/[^/]+/(?P<app>[^/]+)/(?P<page>[^/]+)/\d+')
+SOCKET_URL = re.compile(r'id="otree-live"\s+data-socket-url="([^"]+)"')
+MY_ID = re.compile(r'var js_vars = \{[^;]*"my_id": (\d+)')
+PROBE_PATH = '/static/otree/js/live.js'
+
+
+class Stats:
+    """Samples (seconds) and counters, bucketed by the current number of sessions."""
+
+    def __init__(self):
+        self.level = None  # None while a session is being created
+        self.buckets = {}
+
+    def bucket(self):
+        if self.level is None:
+            return None
+        return self.buckets.setdefault(self.level, dict(
+            probe=[], live=[], post=[], get=[], pages=0, errors=0,
+            live_errors=0, create_seconds=0.0,
+        ))
+
+    def add(self, kind, seconds):
+        bucket = self.bucket()
+        if bucket is not None:
+            bucket[kind].append(seconds)
+
+    def count(self, kind, n=1):
+        bucket = self.bucket()
+        if bucket is not None:
+            bucket[kind] += n
+
+
+def percentile(values, q):
+    if not values:
+        return None
+    values = sorted(values)
+    return values[min(len(values) - 1, int(q * len(values)))]
+
+
+def ms(value):
+    return '-' if value is None else f'{value * 1000:.1f}'
+
+
+# ---------------------------
+# Server + REST
+# ---------------------------
+def start_server(port):
+    # oTree keeps SQLite in ./db.sqlite3 whatever DATABASE_URL says, so run the
+    # server from a scratch directory that links to the project files; the
+    # benchmark never touches your development database
+    project = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix='pgg-capacity-')
+    for name in os.listdir(project):
+        if not name.endswith('.sqlite3'):
+            os.symlink(os.path.join(project, name), os.path.join(workdir, name))
+    env = dict(os.environ, DATABASE_URL=f"sqlite:///{os.path.join(workdir, 'db.sqlite3')}")
+    env.pop('OTREE_AUTH_LEVEL', None)
+    # own process group, so the timeout worker it spawns goes down with it
+    proc = subprocess.Popen(
+        ['otree', 'prodserver1of2', str(port)], cwd=workdir, env=env,
+        stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL,
+        start_new_session=True,
+    )
+    base = f'http://127.0.0.1:{port}'
+    deadline = time.monotonic() + 60
+    while time.monotonic() < deadline:
+        if proc.poll() is not None:
+            raise Exception("oTree server exited during startup")
+        try:
+            requests.get(base + PROBE_PATH, timeout=1)
+            return proc, base
+        except requests.ConnectionError:
+            time.sleep(0.3)
+    stop_server(proc)
+    raise Exception("oTree server did not start within 60 seconds")
+
+
+def stop_server(proc):
+    try:
+        os.killpg(proc.pid, signal.SIGTERM)
+        proc.wait(timeout=10)
+    except (ProcessLookupError, subprocess.TimeoutExpired):
+        os.killpg(proc.pid, signal.SIGKILL)
+
+
+def rest(base, path, payload):
+    headers = {}
+    if os.environ.get('OTREE_REST_KEY'):
+        headers['otree-rest-key'] = os.environ['OTREE_REST_KEY']
+    for attempt in range(5):
+        resp = requests.post(base + path, json=payload, headers=headers, timeout=600)
+        # SQLite: the timeout worker process can hold the write lock briefly
+        if resp.status_code != 500 or 'database is locked' not in resp.text:
+            break
+        time.sleep(1 + attempt)
+    if resp.status_code != 200:
+        raise Exception(f"{path} returned {resp.status_code}: {resp.text[:200]}")
+    return resp.json()
+
+
+def create_session(base, config):
+    info = rest(base, '/api/sessions', dict(
+        session_config_name=config['name'],
+        num_participants=config['num_demo_participants'],
+    ))
+    session = rest(base, f"/api/get_session/{info['code']}", {})
+    return info['code'], [p['code'] for p in session['participants']]
+
+
+# ---------------------------
+# Scripted participant
+# ---------------------------
+class Client:
+    def __init__(self, base, code, stats, pool, formation_seconds, think_seconds):
+        self.base = base
+        self.code = code
+        self.stats = stats
+        self.pool = pool
+        self.formation_seconds = formation_seconds
+        self.think_seconds = think_seconds
+        self.http = requests.Session()
+        self.probes = 0
+
+    async def _call(self, kind, method, url, **kwargs):
+        loop = asyncio.get_running_loop()
+        start = time.monotonic()
+        try:
+            resp = await loop.run_in_executor(
+                self.pool, lambda: method(url, timeout=120, **kwargs)
+            )
+        except requests.RequestException:
+            self.stats.count('errors')
+            return None
+        self.stats.add(kind, time.monotonic() - start)
+        if resp.status_code >= 400:
+            self.stats.count('errors')
+            return None
+        return resp
+
+    async def run(self):
+        resp = await self._call('get', self.http.get, f'{self.base}/InitializeParticipant/{self.code}')
+        while resp is not None:
+            match = PAGE_PATH.search(urlsplit(resp.url).path)
+            if not match:
+                return  # OutOfRangeNotification: participant is done
+            page = match.group('page')
+            if 'otree-wait-page' in resp.text:
+                await asyncio.sleep(0.5)
+                resp = await self._call('get', self.http.get, resp.url)
+                continue
+            if page == 'FinalSummary':
+                return
+            if page == 'Formation':
+                await self.formation(resp)
+            data = {}
+            if page == 'Decision':
+                data = dict(effort_to_firm=random.randint(0, 8))
+            await asyncio.sleep(random.uniform(0.2, self.think_seconds))  # reading time
+            resp = await self._call('post', self.http.post, resp.url, data=data)
+            if resp is not None:
+                self.stats.count('pages')
+
+    async def formation(self, resp):
+        match = SOCKET_URL.search(resp.text)
+        if not match:
+            return
+        ws_url = 'ws' + self.base[len('http'):] + match.group(1).replace('&amp;', '&')
+        id_match = MY_ID.search(resp.text)
+        my_id = int(id_match.group(1)) if id_match else 0
+        stop_at = time.monotonic() + self.formation_seconds
+        try:
+            async with websockets.connect(ws_url, max_size=None) as ws:
+                while time.monotonic() < stop_at:
+                    state = await self.probe(ws, my_id)
+                    if state is None:
+                        return
+                    action = self.pick_action(state, my_id)
+                    if action:
+                        await ws.send(json.dumps(action))
+                    await asyncio.sleep(random.uniform(0.3, 1.2))
+        except (OSError, websockets.WebSocketException):
+            self.stats.count('live_errors')
+
+    async def probe(self, ws, my_id):
+        # applying to your own firm is always rejected with an alert sent only
+        # to you; the alert echoes the msg_id, so the denial of an earlier
+        # action still in flight is not taken for this answer
+        self.probes += 1
+        msg_id = f'probe-{my_id}-{self.probes}'
+        await ws.send(json.dumps(dict(type='apply', owner=my_id, msg_id=msg_id)))
+        start = time.monotonic()
+        while True:
+            try:
+                raw = await asyncio.wait_for(ws.recv(), timeout=30)
+            except asyncio.TimeoutError:
+                self.stats.count('live_errors')
+                return None
+            payload = json.loads(raw).get('live_method_payload')
+            if payload is None:
+                self.stats.count('live_errors')
+                return None
+            if payload.get('msg_id') == msg_id:
+                self.stats.add('live', time.monotonic() - start)
+                return payload['state']
+
+    @staticmethod
+    def pick_action(state, my_id):
+        if not my_id or state['employer'].get(str(my_id)) is not None:
+            return None
+        mine = state['firms'][my_id - 1]
+        if mine['pending'] and mine['slots_left'] > 0:
+            return dict(type='accept', owner=my_id, applicant=random.choice(mine['pending']))
+        open_firms = [
+            f['owner'] for f in state['firms']
+            if f['active'] and f['slots_left'] > 0 and f['owner'] != my_id
+            and f['owner'] not in state['outgoing'][str(my_id)]
+        ]
+        if open_firms and len(mine['members']) == 1 and random.random() < 0.5:
+            return dict(type='apply', owner=random.choice(open_firms))
+        return None
+
+
+# ---------------------------
+# Driver
+# ---------------------------
+async def probe_loop(base, stats, pool, stop):
+    http = requests.Session()
+    loop = asyncio.get_running_loop()
+    while not stop.is_set():
+        start = time.monotonic()
+        try:
+            await loop.run_in_executor(pool, lambda: http.get(base + PROBE_PATH, timeout=60))
+            stats.add('probe', time.monotonic() - start)
+        except requests.RequestException:
+            stats.count('errors')
+        await asyncio.sleep(0.2)
+
+
+async def run_benchmark(args, base):
+    configs_by_name = {c['name']: c for c in settings.SESSION_CONFIGS}
+    if args.configs:
+        names = args.configs.split(',')
+        unknown = [n for n in names if n not in configs_by_name]
+        if unknown:
+            raise Exception(f"Unknown session configs: {', '.join(unknown)}")
+    else:
+        names = [c['name'] for c in settings.SESSION_CONFIGS if not c.get('test_mode')]
+    total_clients = sum(
+        configs_by_name[names[i % len(names)]]['num_demo_participants']
+        for i in range(args.sessions)
+    )
+    pool = ThreadPoolExecutor(max_workers=total_clients + 8)
+    loop = asyncio.get_running_loop()
+    stats = Stats()
+    stop = asyncio.Event()
+    tasks = [asyncio.ensure_future(probe_loop(base, stats, pool, stop))]
+
+    stats.level = 0
+    await asyncio.sleep(args.baseline)
+
+    for k in range(1, args.sessions + 1):
+        config = configs_by_name[names[(k - 1) % len(names)]]
+        stats.level = None
+        start = time.monotonic()
+        code, participant_codes = await loop.run_in_executor(pool, create_session, base, config)
+        create_seconds = time.monotonic() - start
+        for pcode in participant_codes:
+            client = Client(base, pcode, stats, pool, args.formation_seconds, args.think_seconds)
+            tasks.append(asyncio.ensure_future(client.run()))
+        stats.level = k
+        stats.bucket()['create_seconds'] = create_seconds
+        print(f"K={k}: added {config['name']} ({len(participant_codes)} players, "
+              f"session {code}, created in {create_seconds:.1f}s)", flush=True)
+        await asyncio.sleep(args.window)
+
+    stats.level = None
+    stop.set()
+    for task in tasks:
+        task.cancel()
+    await asyncio.gather(*tasks, return_exceptions=True)
+    pool.shutdown(wait=False, cancel_futures=True)
+    return summarize(stats, names, args.sessions, args.window)
+
+
+def summarize(stats, names, sessions, window):
+    idle_samples = stats.buckets.get(0, {}).get('probe')
+    idle = statistics.median(idle_samples) if idle_samples else 0.0
+    rows = []
+    for k in range(1, sessions + 1):
+        b = stats.buckets[k]
+        lag = [max(0.0, s - idle) for s in b['probe']]
+        rows.append(dict(
+            sessions=k,
+            config=names[(k - 1) % len(names)],
+            create_seconds=round(b['create_seconds'], 2),
+            pages=b['pages'],
+            loop_lag_p50=percentile(lag, 0.5),
+            loop_lag_p95=percentile(lag, 0.95),
+            loop_lag_max=max(lag) if lag else None,
+            live_p50=percentile(b['live'], 0.5),
+            live_p95=percentile(b['live'], 0.95),
+            live_samples=len(b['live']),
+            post_p50=percentile(b['post'], 0.5),
+            post_p95=percentile(b['post'], 0.95),
+            errors=b['errors'],
+            live_errors=b['live_errors'],
+        ))
+    return dict(idle_probe_seconds=idle, window_seconds=window, levels=rows)
+
+
+def print_table(report):
+    window = report['window_seconds']
+    print(f"\nidle probe latency: {report['idle_probe_seconds'] * 1000:.1f} ms"
+          f"  (all times in ms; lag = probe latency above idle)")
+    header = (f"{'K':>3} {'added config':<26} {'create s':>8} {'pages/s':>8} "
+              f"{'lag p50':>8} {'lag p95':>8} {'lag max':>8} "
+              f"{'live p50':>9} {'live p95':>9} {'post p50':>9} {'post p95':>9} {'errors':>7}")
+    print(header)
+    print('-' * len(header))
+    for r in report['levels']:
+        print(f"{r['sessions']:>3} {r['config']:<26} {r['create_seconds']:>8.1f} "
+              f"{r['pages'] / window:>8.2f} "
+              f"{ms(r['loop_lag_p50']):>8} {ms(r['loop_lag_p95']):>8} {ms(r['loop_lag_max']):>8} "
+              f"{ms(r['live_p50']):>9} {ms(r['live_p95']):>9} "
+              f"{ms(r['post_p50']):>9} {ms(r['post_p95']):>9} "
+              f"{r['errors'] + r['live_errors']:>7}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--sessions', type=int, default=4, help="number of sessions to add (K)")
+    parser.add_argument('--configs', help="comma-separated config names to cycle through "
+                                          "(default: every config without test_mode)")
+    parser.add_argument('--window', type=float, default=30, help="seconds measured per K")
+    parser.add_argument('--baseline', type=float, default=5, help="seconds of idle probing")
+    parser.add_argument('--formation-seconds', type=float, default=8,
+                        help="seconds each client spends on Formation before submitting")
+    parser.add_argument('--think-seconds', type=float, default=1.0,
+                        help="upper bound of the random pause before each page submission; "
+                             "raise it (e.g. 10) to approximate human pacing")
+    parser.add_argument('--url', help="benchmark an already running server instead")
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--json', help="also write the report to this file")
+    args = parser.parse_args()
+
+    proc = None
+    if args.url:
+        base = args.url.rstrip('/')
+    else:
+        proc, base = start_server(args.port)
+    try:
+        report = asyncio.run(run_benchmark(args, base))
+    finally:
+        if proc:
+            stop_server(proc)
+    print_table(report)
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,319 @@
+"""
+Structural estimation of effort decisions: two-limit Tobit models of
+`effort_to_firm` on what a player saw on the previous round's Relay page.
+
+Input is the custom export of either app (Data page, `pg_exogenous_custom.csv`
+/ `pg_endogenous_custom.csv`); any number of files, sessions and treatments
+can be passed at once. The panel is loaded into NumPy arrays once. A row is a
+decision: a player in a firm (size > 1) in this round and in the previous one.
+
+    effort* = size dummies + b'x + e,   e ~ N(0, sigma^2)
+    effort  = min(max(effort*, 0), ENDOWMENT)
+
+Regressors x by model (all lagged one round, i.e. as shown on Relay):
+
+    cc          lag_firm_pce    per-capita effort of the player's own firm
+                lag_market_pce  mean per-capita effort over all firms of the
+                                player's market (the session; the cohort in
+                                pg_exogenous)
+    learning    lag_effort      the player's own effort
+                round           round number
+    full        all four
+
+The likelihood and its gradient are evaluated in vectorized form. Standard
+errors are bootstrapped over sessions (the independent units): a replicate
+draws sessions with replacement, which only changes a weight per row, so the
+arrays are never copied. Replicates run in a process pool; each has its own
+seed from --seed, so results do not depend on --workers. From this directory
+(`pip install -r requirements_analysis.txt` first):
+
+    python estimation.py pg_exogenous_custom.csv pg_endogenous_custom.csv
+    python estimation.py *.csv --model full --reps 1000 --workers 8
+    python estimation.py *.csv --treatments T1_exogenous_constant,T3_endogenous_constant
+
+With two or more treatments, the coefficients of each are compared with the
+first (difference and bootstrap standard error).
+"""
+import argparse
+import csv
+import math
+import os
+import sys
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+try:
+    import numpy as np
+    from scipy import optimize, special
+except ImportError as e:
+    raise Exception(f"estimation.py needs {e.name}: pip install -r requirements_analysis.txt")
+
+
+ENDOWMENT = 8  # C.ENDOWMENT in both apps: efforts are censored at 0 and here
+MODELS = {
+    'cc': ('lag_firm_pce', 'lag_market_pce'),
+    'learning': ('lag_effort', 'round'),
+    'full': ('lag_firm_pce', 'lag_market_pce', 'lag_effort', 'round'),
+}
+HALF_LOG_2PI = 0.5 * math.log(2 * math.pi)
+
+
+# ---------------------------
+# Panel
+# ---------------------------
+
+
+def load_panel(paths):
+    """Decision rows of the custom exports in `paths`, as a dict of arrays."""
+    cols = {k: [] for k in ('treatment', 'session', 'participant', 'round', 'cohort',
+                            'size', 'effort_cents', 'total_effort_cents')}
+    for path in paths:
+        with open(path, newline='') as f:
+            for r in csv.DictReader(f):
+                cols['treatment'].append(r['treatment'])
+                cols['session'].append(r['session_code'])
+                cols['participant'].append(r['participant_code'])
+                cols['round'].append(int(r['round_number']))
+                cols['cohort'].append(int(r.get('cohort') or 1))
+                cols['size'].append(int(r['firm_size'] or 0))
+                cols['effort_cents'].append(int(r['effort_cents'] or 0))
+                cols['total_effort_cents'].append(int(r['total_effort_cents'] or 0))
+    if not cols['round']:
+        raise Exception(f"No rows in {', '.join(paths)}")
+
+    treatment = np.array(cols['treatment'])
+    sessions, session = np.unique(np.array(cols['session']), return_inverse=True)
+    _, part = np.unique(np.array(cols['participant']), return_inverse=True)
+    rnd = np.array(cols['round'])
+    size = np.array(cols['size'])
+    effort = np.array(cols['effort_cents']) / 100
+    firm_pce = np.divide(np.array(cols['total_effort_cents']) / 100, size,
+                         out=np.zeros(len(size)), where=size > 0)
+    _, market = np.unique(session * 1000 + np.array(cols['cohort']), return_inverse=True)
+
+    num_rounds = rnd.max() + 1
+    cell = part * num_rounds + rnd
+    if len(np.unique(cell)) != len(cell):
+        raise Exception("Some player-rounds appear twice (was a file passed twice?)")
+
+    # everything a player saw last round, on a (participant, round) grid
+    def grid(values):
+        out = np.full((part.max() + 1) * num_rounds, np.nan)
+        out[cell] = values
+        return out.reshape(-1, num_rounds)
+
+    effort_grid, size_grid, pce_grid = grid(effort), grid(size), grid(firm_pce)
+
+    # market mean of per-capita effort over firms: a firm of size s has s rows,
+    # so each row counts 1/s
+    in_firm = size > 1
+    w = np.where(in_firm, 1 / np.maximum(size, 1), 0)
+    market_cell = market * num_rounds + rnd
+    n_cells = (market.max() + 1) * num_rounds
+    firms = np.bincount(market_cell, weights=w, minlength=n_cells)
+    pce_sum = np.bincount(market_cell, weights=w * firm_pce, minlength=n_cells)
+    market_pce = np.divide(pce_sum, firms, out=np.full(n_cells, np.nan), where=firms > 0)
+
+    prev = np.maximum(rnd - 1, 0)
+    lag_size = size_grid[part, prev]
+    lag_market_pce = market_pce[market * num_rounds + prev]
+    keep = in_firm & (rnd > 1) & (lag_size > 1) & np.isfinite(lag_market_pce)
+
+    return dict(
+        sessions=sessions,
+        treatment=treatment[keep],
+        session=session[keep],
+        size=size[keep],
+        effort=effort[keep],
+        lag_effort=effort_grid[part, prev][keep],
+        lag_firm_pce=pce_grid[part, prev][keep],
+        lag_market_pce=lag_market_pce[keep],
+        round=rnd[keep].astype(float),
+    )
+
+
+def design(panel, rows, model):
+    """(X, names) for `rows` of the panel: one intercept per firm size, then the model."""
+    sizes = np.unique(panel['size'][rows])
+    columns = [(panel['size'][rows] == s).astype(float) for s in sizes]
+    columns += [panel[name][rows] for name in MODELS[model]]
+    names = [f'size{s}' for s in sizes] + list(MODELS[model])
+    return np.column_stack(columns), names
+
+
+# ---------------------------
+# Two-limit Tobit
+# ---------------------------
+
+
+def censoring(y):
+    """+1 at the lower limit, -1 at the upper one, 0 in between."""
+    return np.where(y <= 0, 1.0, np.where(y >= ENDOWMENT, -1.0, 0.0))
+
+
+def tobit_nll(theta, X, y, side, weights):
+    """Negative log-likelihood and its gradient; theta = (beta..., log sigma)."""
+    log_sigma = theta[-1]
+    sigma = math.exp(log_sigma)
+    z = (y - X @ theta[:-1]) / sigma
+    mid = side == 0
+    cens = ~mid
+    zc = side[cens] * z[cens]
+
+    ll = np.empty_like(z)
+    dz = np.empty_like(z)  # d ll / d z
+    ll[mid] = -0.5 * z[mid] ** 2 - HALF_LOG_2PI - log_sigma
+    dz[mid] = -z[mid]
+    ll[cens] = special.log_ndtr(zc)
+    dz[cens] = side[cens] * np.exp(-0.5 * zc ** 2 - HALF_LOG_2PI - ll[cens])
+
+    # z depends on beta through -x/sigma and on log sigma through -z
+    wdz = weights * dz
+    grad = np.empty_like(theta)
+    grad[:-1] = X.T @ (-wdz / sigma)
+    grad[-1] = -(wdz @ z) - weights[mid].sum()
+    return -(weights @ ll), -grad
+
+
+def ols_start(X, y):
+    beta = np.linalg.lstsq(X, y, rcond=None)[0]
+    resid = y - X @ beta
+    return np.append(beta, math.log(max(resid.std(), 0.1)))
+
+
+def fit(X, y, side, weights, start):
+    # the mean (not the sum) keeps BFGS's gradient tolerance independent of the sample size
+    res = optimize.minimize(tobit_nll, start, args=(X, y, side, weights / weights.sum()),
+                            jac=True, method='BFGS')
+    return res.x, res.success
+
+
+# ---------------------------
+# Bootstrap (process pool)
+# ---------------------------
+
+
+_WORK = {}
+
+
+def _init_worker(X, y, side, cluster, start):
+    _WORK.update(X=X, y=y, side=side, cluster=cluster, start=start,
+                 num_clusters=cluster.max() + 1)
+
+
+def _replicates(seeds):
+    w = _WORK
+    out = np.empty((len(seeds), len(w['start'])))
+    for i, seed in enumerate(seeds):
+        rng = np.random.default_rng(seed)
+        n = w['num_clusters']
+        draws = np.bincount(rng.integers(n, size=n), minlength=n).astype(float)
+        theta, ok = fit(w['X'], w['y'], w['side'], draws[w['cluster']], w['start'])
+        out[i] = theta if ok else np.nan
+    return out
+
+
+def bootstrap(X, y, side, cluster, start, seeds, workers=1):
+    """One estimate per seed (NaN rows where BFGS did not converge), in seed order."""
+    args = (X, y, side, cluster, start)
+    if workers > 1 and len(seeds) > 1:
+        # contiguous chunks, a few per worker, so results come back in seed order
+        step = max(1, math.ceil(len(seeds) / (workers * 4)))
+        chunks = [seeds[i:i + step] for i in range(0, len(seeds), step)]
+        with ProcessPoolExecutor(workers, initializer=_init_worker, initargs=args) as pool:
+            return np.concatenate(list(pool.map(_replicates, chunks)))
+    _init_worker(*args)
+    return _replicates(seeds)
+
+
+def estimate(panel, treatment, model='cc', reps=200, seed=None, workers=1):
+    """Point estimates and session-bootstrap SEs for one treatment."""
+    rows = panel['treatment'] == treatment
+    X, names = design(panel, rows, model)
+    y = panel['effort'][rows]
+    side = censoring(y)
+    _, cluster = np.unique(panel['session'][rows], return_inverse=True)
+    if not (side == 0).any():
+        raise Exception(f"{treatment}: every effort is at 0 or {ENDOWMENT}, the model is not identified")
+
+    theta, ok = fit(X, y, side, np.ones(len(y)), ols_start(X, y))
+    if not ok:
+        raise Exception(f"{treatment}: the {model} model did not converge")
+    seed = seed if isinstance(seed, np.random.SeedSequence) else np.random.SeedSequence(seed)
+    reps_theta = bootstrap(X, y, side, cluster, theta, seed.spawn(reps), workers)
+
+    # report sigma itself, not its log
+    theta = np.append(theta[:-1], math.exp(theta[-1]))
+    reps_theta[:, -1] = np.exp(reps_theta[:, -1])
+    good = reps_theta[np.isfinite(reps_theta).all(axis=1)]
+    return dict(
+        treatment=treatment,
+        model=model,
+        names=names + ['sigma'],
+        theta=theta,
+        se=good.std(axis=0, ddof=1) if len(good) > 1 else np.full(len(theta), np.nan),
+        replicates=good,
+        failed=reps - len(good),
+        decisions=len(y),
+        sessions=cluster.max() + 1,
+        censored=((side == 1).mean(), (side == -1).mean()),
+    )
+
+
+def compare(a, b):
+    """[(name, b - a, se)] for the coefficients both fits have (independent samples)."""
+    out = []
+    for name in a['names']:
+        if name in b['names']:
+            i, j = a['names'].index(name), b['names'].index(name)
+            diff = b['theta'][j] - a['theta'][i]
+            se = math.sqrt(a['se'][i] ** 2 + b['se'][j] ** 2)
+            out.append((name, diff, se))
+    return out
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('files', nargs='+', help="custom export CSVs of either app")
+    parser.add_argument('--model', choices=sorted(MODELS), default='cc')
+    parser.add_argument('--treatments', help="comma-separated session config names (default: all)")
+    parser.add_argument('--reps', type=int, default=200, help="bootstrap replicates per treatment")
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--workers', type=int, default=os.cpu_count() or 1)
+    args = parser.parse_args()
+
+    t0 = time.perf_counter()
+    panel = load_panel(args.files)
+    treatments = args.treatments.split(',') if args.treatments else sorted(set(panel['treatment']))
+    print(f"{len(panel['effort'])} decisions from {len(panel['sessions'])} session(s) "
+          f"in {time.perf_counter() - t0:.2f}s")
+
+    fits = []
+    seeds = np.random.SeedSequence(args.seed).spawn(len(treatments))
+    for treatment, seed in zip(treatments, seeds):
+        if not (panel['treatment'] == treatment).any():
+            print(f"\n  {treatment}: no decisions")
+            continue
+        t0 = time.perf_counter()
+        r = estimate(panel, treatment, args.model, args.reps, seed, args.workers)
+        fits.append(r)
+        print(f"\n  {treatment} ({args.model}): {r['decisions']} decisions, {r['sessions']} session(s), "
+              f"censored {r['censored'][0]:.0%} at 0 / {r['censored'][1]:.0%} at {ENDOWMENT}, "
+              f"{args.reps} replicates ({r['failed']} failed) in {time.perf_counter() - t0:.1f}s")
+        print(f"  {'':<18}{'coef':>9}{'se':>9}")
+        for name, coef, se in zip(r['names'], r['theta'], r['se']):
+            print(f"  {name:<18}{coef:>9.3f}{se:>9.3f}")
+        if r['sessions'] < 2:
+            print("  (one session: the bootstrap cannot vary, SEs are not meaningful)")
+
+    for other in fits[1:]:
+        print(f"\n  {other['treatment']} - {fits[0]['treatment']}")
+        print(f"  {'':<18}{'diff':>9}{'se':>9}{'z':>7}")
+        for name, diff, se in compare(fits[0], other):
+            z = diff / se if se > 0 else float('nan')
+            print(f"  {name:<18}{diff:>9.3f}{se:>9.3f}{z:>7.2f}")
+    return 0 if fits else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
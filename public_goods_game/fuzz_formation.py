@@ -0,0 +1,355 @@
+"""
+Property-based fuzzer for the hiring-market rules of pg_endogenous.
+
+Runs random apply / withdraw / accept / reject sequences (single actions and
+the batch messages) straight against the pure formation-state functions that
+live_formation and finalize_formation use, without a server or database. After
+every step it checks:
+
+- nobody is employed twice, and employer[] agrees with accepted[]
+- firm size <= C.MAX_FIRM_SIZE
+- inactive owners (employed elsewhere) have no pending or accepted workers
+- pending applicants are unemployed, have not hired, and are not the owner
+- a refused message leaves the state untouched; a successful one bumps rev
+  by exactly 1 when some firm card changed (a batch can net out to nothing)
+- malformed messages (wrong types where lists, dicts or ids belong) are
+  refused, not raised
+
+and at the end of every case, that the finalize matrix partitions all players
+into valid firms and singletons.
+
+Cases are spread over all cores. A failing case is shrunk (fewer actions, then
+fewer players), printed, and saved so it can be replayed.
+
+Usage, from this directory:
+
+    python fuzz_formation.py                           # 20000 cases on every core
+    python fuzz_formation.py --cases 200000 --max-steps 300 --seed 7
+    python fuzz_formation.py --replay fuzz_failure.json
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import random
+import sys
+import time
+
+from pg_endogenous import C, _apply_message, _firm_signatures, _formation_matrix, _initial_state
+
+
+SINGLE_TYPES = ('apply', 'withdraw', 'accept', 'reject')
+ACTION_TYPES = SINGLE_TYPES + ('apply_many', 'accept_many', 'reject_all', 'batch')
+ACTION_WEIGHTS = (6, 2, 5, 3, 1, 1, 1, 1)
+# what a broken or hostile client may send; each must be refused
+MALFORMED = (
+    dict(type='apply_many', owners=5),
+    dict(type='apply_many', owners=['x', None, [1]]),
+    dict(type='accept_many', applicants=3),
+    dict(type='accept_many', owner='x', applicants=[1]),
+    dict(type='reject_all', owner='x'),
+    dict(type='reject_all', owner=[1]),
+    dict(type='batch', actions=[1, 2]),
+    dict(type='batch', actions={'type': 'apply', 'owner': 1}),
+    dict(type='batch', actions=[dict(type='apply', owner={})]),
+    dict(type='apply', owner='x'),
+    dict(type='withdraw', owner=[2]),
+    dict(type='accept', owner=None, applicant={}),
+    dict(type='reject', owner=1.5, applicant='y'),
+    dict(type='apply', owner=True),
+)
+MALFORMED_RATE = 0.02
+# compared serialized: True == 1 in Python, so dict equality would confuse them
+MALFORMED_KEYS = {json.dumps(m, sort_keys=True) for m in MALFORMED}
+
+
+class Failure(Exception):
+    pass
+
+
+# ---------------------------
+# Random actions
+# ---------------------------
+
+
+def random_action(rng, state, n):
+    """A random (pid, message), biased towards moves that can succeed."""
+    pid = rng.randint(1, n)
+    if rng.random() < MALFORMED_RATE:
+        return pid, dict(rng.choice(MALFORMED))
+    msg_type = rng.choices(ACTION_TYPES, weights=ACTION_WEIGHTS)[0]
+    if msg_type == 'batch':
+        actions = [random_single(rng, state, n, pid) for _ in range(rng.randint(0, 4))]
+        if actions and rng.random() < 0.05:
+            actions[-1] = dict(type=rng.choice(('ping', 'reject_all')))
+        return pid, dict(type='batch', actions=actions)
+    if msg_type == 'apply_many':
+        return pid, dict(type='apply_many', owners=[any_owner(rng, n) for _ in range(rng.randint(0, 4))])
+    if msg_type == 'accept_many':
+        pending = state['pending'][str(pid)]
+        applicants = rng.sample(pending, rng.randint(0, len(pending))) if pending else [rng.randint(1, n)]
+        return pid, dict(type='accept_many', owner=pid, applicants=applicants)
+    if msg_type == 'reject_all':
+        return pid, dict(type='reject_all', owner=pid if rng.random() < 0.9 else any_owner(rng, n))
+    return pid, random_single(rng, state, n, pid, msg_type)
+
+
+def random_single(rng, state, n, pid, msg_type=None):
+    msg_type = msg_type or rng.choice(SINGLE_TYPES)
+    if msg_type in ('apply', 'withdraw'):
+        return dict(type=msg_type, owner=any_owner(rng, n))
+    pending = state['pending'][str(pid)]
+    applicant = rng.choice(pending) if pending and rng.random() < 0.9 else rng.randint(1, n)
+    owner = pid if rng.random() < 0.9 else any_owner(rng, n)
+    return dict(type=msg_type, owner=owner, applicant=applicant)
+
+
+def any_owner(rng, n):
+    # occasionally out of range (0 or n + 1)
+    return rng.randint(0, n + 1) if rng.random() < 0.05 else rng.randint(1, n)
+
+
+# ---------------------------
+# Properties
+# ---------------------------
+
+
+def check_state(state, n):
+    employer, pending, accepted = state['employer'], state['pending'], state['accepted']
+    seen = set()
+    for owner in range(1, n + 1):
+        o = str(owner)
+        if 1 + len(accepted[o]) > C.MAX_FIRM_SIZE:
+            raise Failure(f"firm size: firm {owner} has {1 + len(accepted[o])} members")
+        for w in accepted[o]:
+            if w in seen:
+                raise Failure(f"employed twice: worker {w}")
+            seen.add(w)
+            if employer[str(w)] != owner:
+                raise Failure(f"employer mismatch: worker {w} in firm {owner}, employer {employer[str(w)]}")
+        if employer[o] is not None:
+            if employer[o] == owner or owner not in accepted[str(employer[o])]:
+                raise Failure(f"employer mismatch: {owner} has employer {employer[o]}")
+            if pending[o] or accepted[o]:
+                raise Failure(f"inactive owner: {owner} still has pending {pending[o]} / accepted {accepted[o]}")
+        if len(set(pending[o])) != len(pending[o]):
+            raise Failure(f"duplicate application: firm {owner} pending {pending[o]}")
+        for a in pending[o]:
+            if a == owner or employer[str(a)] is not None or accepted[str(a)]:
+                raise Failure(f"bad pending: applicant {a} at firm {owner}")
+    if len(seen) != sum(1 for e in employer.values() if e is not None):
+        raise Failure("employer mismatch: employer[] lists workers no firm accepted")
+
+
+def snapshot(state):
+    # everything a message may change; far cheaper than json.dumps per step
+    # (rejections are append-only, so their count is enough)
+    return (_firm_signatures(state), tuple(state['employer'].values()),
+            len(state['rejections']), state['rev'])
+
+
+def check_step(before, state, error):
+    after = snapshot(state)
+    if error:
+        if after != before:
+            raise Failure(f"refused message changed state: {error}")
+        return
+    before_signatures, _, _, before_rev = before
+    expected = before_rev + (after[0] != before_signatures)
+    if state['rev'] != expected:
+        raise Failure(f"rev: {before_rev} -> {state['rev']} on success, expected {expected}")
+
+
+def check_matrix(state, n):
+    closed = json.loads(json.dumps(state))
+    matrix, operating = _formation_matrix(closed, n)
+    ids = sorted(i for members in matrix for i in members)
+    if ids != list(range(1, n + 1)):
+        raise Failure(f"partition: matrix {matrix} does not cover 1..{n} exactly once")
+    for members in matrix:
+        if len(members) == 1:
+            continue
+        owner = members[0]
+        if (owner not in operating or state['employer'][str(owner)] is not None
+                or members[1:] != state['accepted'][str(owner)]
+                or len(members) > C.MAX_FIRM_SIZE):
+            raise Failure(f"partition: bad firm {members}")
+    if any(closed['pending'].values()):
+        raise Failure("partition: applications still pending after close")
+
+
+# ---------------------------
+# Running and shrinking
+# ---------------------------
+
+
+def step(state, n, pid, data):
+    """Apply one message and check every per-step property. Returns the new state."""
+    before = snapshot(state)
+    state, error = _apply_message(state, pid, n, data)
+    if error is None and json.dumps(data, sort_keys=True) in MALFORMED_KEYS:
+        raise Failure(f"malformed message accepted: {data}")
+    check_step(before, state, error)
+    check_state(state, n)
+    return state
+
+
+def replay(n, actions):
+    """Run a recorded case. Returns None, or (step index, failure message)."""
+    state = _initial_state(n)
+    for i, (pid, data) in enumerate(actions):
+        try:
+            state = step(state, n, pid, data)
+        except Exception as exc:
+            return i, _describe(exc)
+    try:
+        check_matrix(state, n)
+    except Exception as exc:
+        return len(actions), _describe(exc)
+    return None
+
+
+def _describe(exc):
+    if isinstance(exc, Failure):
+        return str(exc)
+    return f"crash: {type(exc).__name__}: {exc}"
+
+
+def _kind(message):
+    return message.split(':')[0]
+
+
+def run_case(case_seed, max_n, max_steps):
+    rng = random.Random(case_seed)
+    n = rng.randint(2, max_n)
+    steps = rng.randint(1, max_steps)
+    state = _initial_state(n)
+    actions = []
+    try:
+        for _ in range(steps):
+            pid, data = random_action(rng, state, n)
+            actions.append((pid, data))
+            state = step(state, n, pid, data)
+        check_matrix(state, n)
+    except Exception as exc:
+        return steps, dict(seed=case_seed, n=n, actions=actions, message=_describe(exc))
+    return steps, None
+
+
+def run_chunk(args):
+    base_seed, start, count, max_n, max_steps = args
+    total_steps = 0
+    for i in range(start, start + count):
+        steps, failure = run_case(f"{base_seed}-{i}", max_n, max_steps)
+        total_steps += steps
+        if failure:
+            return i - start + 1, total_steps, failure
+    return count, total_steps, None
+
+
+def shrink(n, actions, message):
+    """Smallest (n, actions) found that still fails the same way."""
+    kind = _kind(message)
+
+    def fails(n_, actions_):
+        result = replay(n_, actions_)
+        return result is not None and _kind(result[1]) == kind
+
+    # nothing after the failing step matters
+    step = replay(n, actions)[0]
+    actions = actions[:step + 1]
+
+    # drop chunks of actions, halving the chunk size down to single actions
+    chunk = max(1, len(actions) // 2)
+    while True:
+        i = 0
+        while i < len(actions):
+            candidate = actions[:i] + actions[i + chunk:]
+            if candidate and fails(n, candidate):
+                actions = candidate
+            else:
+                i += chunk
+        if chunk == 1:
+            break
+        chunk //= 2
+
+    # fewer players, when every id in the case still fits
+    for m in range(2, n):
+        if max(_ids(actions), default=0) <= m and fails(m, actions):
+            n = m
+            break
+    return n, actions, replay(n, actions)[1]
+
+
+def _ids(actions):
+    for pid, data in actions:
+        yield pid
+        for action in [data] + list(data.get('actions') or []):
+            for key in ('owner', 'applicant'):
+                if isinstance(action.get(key), int):
+                    yield action[key]
+            for key in ('owners', 'applicants'):
+                yield from action.get(key) or []
+
+
+def report(n, actions, message, out):
+    print(f"\nFAILED: {message}")
+    print(f"shrunk to n={n}, {len(actions)} action(s):")
+    for pid, data in actions:
+        print(f"  player {pid}: {json.dumps(data)}")
+    with open(out, 'w') as f:
+        json.dump(dict(n=n, actions=actions, message=message), f, indent=1)
+    print(f"saved to {out} (replay with --replay {out})")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--cases', type=int, default=20000, help="number of random cases")
+    parser.add_argument('--max-n', type=int, default=18, help="largest market size (min 2)")
+    parser.add_argument('--max-steps', type=int, default=200, help="most messages per case")
+    parser.add_argument('--seed', default='0', help="base seed; case i uses '<seed>-<i>'")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="processes")
+    parser.add_argument('--chunk', type=int, default=250, help="cases per task")
+    parser.add_argument('--out', default='fuzz_failure.json', help="where to save a failing case")
+    parser.add_argument('--replay', help="re-run a saved failing case instead of fuzzing")
+    args = parser.parse_args()
+
+    if args.replay:
+        with open(args.replay) as f:
+            case = json.load(f)
+        result = replay(case['n'], [tuple(a) for a in case['actions']])
+        if result is None:
+            print("case passes")
+            return 0
+        print(f"fails at action {result[0]}: {result[1]}")
+        return 1
+
+    tasks = [
+        (args.seed, start, min(args.chunk, args.cases - start), args.max_n, args.max_steps)
+        for start in range(0, args.cases, args.chunk)
+    ]
+    t0 = time.perf_counter()
+    cases = steps = 0
+    failure = None
+    with multiprocessing.Pool(args.workers) as pool:
+        for done, done_steps, found in pool.imap_unordered(run_chunk, tasks):
+            cases += done
+            steps += done_steps
+            if found:
+                failure = found
+                pool.terminate()
+                break
+    elapsed = time.perf_counter() - t0
+    print(f"{cases} cases, {steps} messages in {elapsed:.1f}s "
+          f"({steps / elapsed:,.0f} messages/s on {args.workers} workers)")
+
+    if failure:
+        print(f"case {failure['seed']} (n={failure['n']}, {len(failure['actions'])} actions): {failure['message']}")
+        report(*shrink(failure['n'], failure['actions'], failure['message']), args.out)
+        return 1
+    print("all properties held")
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
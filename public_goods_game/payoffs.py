@@ -0,0 +1,61 @@
+"""
+Payoff arithmetic shared by pg_exogenous and pg_endogenous.
+
+Effort and payoffs are kept in integer hundredths of a point ("cents"), so
+sums are exact and the per-capita payout is rounded once to the cent. The
+returns parameters come from the caller (its C.MPCR_BY_SIZE and the session
+config), as for benchmark.py.
+"""
+
+
+def to_cents(x) -> int:
+    return round(float(x or 0.0) * 100)
+
+
+def cents_str(cents: int) -> str:
+    # "12.34" straight from integer cents, no float formatting
+    sign = '-' if cents < 0 else ''
+    cents = abs(cents)
+    return f"{sign}{cents // 100}.{cents % 100:02d}"
+
+
+def per_capita_payout_cents(config, mpcr_by_size, n: int, total_effort_cents: int) -> int:
+    # STRICT: avoids accidentally running the wrong treatment
+    returns_type = config['returns_type']
+
+    if returns_type == 'constant':
+        # MPCR by firm size, e.g. {2: 0.65, 3: 0.55, 4: 0.49, 5: 0.45, 6: 0.42}
+        if n not in mpcr_by_size:
+            raise Exception(f"No MPCR specified for firm size n={n}. Check C.MPCR_BY_SIZE.")
+        return round(mpcr_by_size[n] * total_effort_cents)
+
+    elif returns_type == 'increasing':
+        # power production: output = a * E^b, shared equally
+        a = float(config['a'])
+        b = float(config['b'])
+        if total_effort_cents <= 0:
+            return 0
+        output = a * ((total_effort_cents / 100) ** b)
+        return round(100 * output / n)
+
+    else:
+        raise Exception(f"Unknown returns_type: {returns_type}")
+
+
+def payoff_preview(config, mpcr_by_size, n: int, endowment: int):
+    """
+    What the Decision page needs to preview the firm payout while the slider
+    moves, without a server round-trip: the MPCR of this firm size (constant
+    returns) or the curve parameters a, b (increasing returns). The page
+    evaluates them with the rounding of per_capita_payout_cents.
+    """
+    returns_type = config['returns_type']
+    preview = dict(kind=returns_type, n=n, endowment=endowment)
+    if returns_type == 'constant':
+        preview['mpcr'] = mpcr_by_size.get(n, 0)
+    elif returns_type == 'increasing':
+        preview['a'] = float(config['a'])
+        preview['b'] = float(config['b'])
+    else:
+        raise Exception(f"Unknown returns_type: {returns_type}")
+    return preview
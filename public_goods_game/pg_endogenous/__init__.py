@@ -1,5 +1,22 @@
 from otree.api import *
+from collections import OrderedDict
 import json
+import logging
+import time
+
+from sqlalchemy import Index
+
+import analytics
+import payoffs
+import profiling
+
+from . import backends
+from . import benchmark
+from . import monitor
+from . import relay
+
+
+logger = logging.getLogger(__name__)
 
 
 
@@ -25,6 +42,13 @@ class C(BaseConstants):
 
    MAX_FIRM_SIZE = 6
 
+   # how many recent client message ids are remembered per player (live_formation)
+   DEDUP_WINDOW = 16
+
+   # board snapshots (session config snapshot_seconds / snapshot_keyframe_every)
+   SNAPSHOT_SECONDS = 1
+   SNAPSHOT_KEYFRAME_EVERY = 10
+
 
    # Table 2 MPCR (constant returns), indexed by firm size n
    MPCR_BY_SIZE = {2: 0.65, 3: 0.55, 4: 0.49, 5: 0.45, 6: 0.42}
@@ -36,6 +60,22 @@ class Subsession(BaseSubsession):
    formation_state = models.LongStringField(initial='')
    formation_finalized = models.BooleanField(initial=False)
 
+   # (owner, worker) employment history through this round (JSON), carried
+   # forward from the previous round by finalize_formation
+   employment_history = models.LongStringField(initial='')
+
+   # resume history of all players for rounds < this one (JSON), filled in
+   # by prewarm_next_round() while the previous round sits on Relay
+   resume_snapshot = models.LongStringField(initial='')
+
+   # number of groups whose payoffs are set (see after_results)
+   groups_paid = models.IntegerField(initial=0)
+
+   # efficiency vs. the surplus-maximizing partition (see benchmark.py)
+   optimum_surplus = models.FloatField(initial=0)
+   structure_efficiency = models.FloatField(initial=0)
+   realized_efficiency = models.FloatField(initial=0)
+
 
 
 
@@ -45,6 +85,10 @@ class Group(BaseGroup):
    per_capita_effort = models.FloatField(initial=0)
    per_capita_payout = models.FloatField(initial=0)
 
+   # exact integer versions, in hundredths of a point
+   total_effort_cents = models.IntegerField(initial=0)
+   per_capita_payout_cents = models.IntegerField(initial=0)
+
 
 
 
@@ -61,9 +105,19 @@ class Player(BasePlayer):
    is_autarkic = models.BooleanField(initial=True)
 
 
+   # unix time at which this player's Formation page times out, set when they
+   # first see it (0 = not shown yet); see formation_seconds_left
+   formation_deadline = models.FloatField(initial=0)
+
+
    # --- Decision (effort allocation) ---
    effort_to_firm = models.FloatField(min=0, max=C.ENDOWMENT, initial=0)
 
+   # exact integer versions, in hundredths of a point (effort_cents is set
+   # from effort_to_firm when Decision is submitted)
+   effort_cents = models.IntegerField(initial=0)
+   payoff_cents = models.IntegerField(initial=0)
+
 
    # --- Resume / history stats (saved each round so we can display later) ---
    # store member ids like "2,1,3" (easy to export/display)
@@ -79,6 +133,52 @@ class Player(BasePlayer):
    was_terminated = models.BooleanField(initial=False)
 
 
+   # --- Tenure / turnover (from Subsession.employment_history) ---
+   # consecutive rounds employed by the current owner, this one included
+   # (0 for owners and autarkic players)
+   tenure_with_owner = models.IntegerField(initial=0)
+   # cumulative through this round
+   terminations_made = models.IntegerField(initial=0)    # as an owner
+   times_terminated = models.IntegerField(initial=0)     # as an employee
+   employers_so_far = models.IntegerField(initial=0)     # distinct owners worked for
+
+
+
+
+class Membership(ExtraModel):
+   # one row per member of each operating firm (size >= 2) per round, written
+   # once by finalize_formation; autarkic players have no row
+   subsession = models.Link(Subsession)
+   session_code = models.StringField()
+   round_number = models.IntegerField()
+   owner = models.IntegerField()
+   member = models.IntegerField()   # the owner is a member of their own firm
+
+   __table_args__ = (
+       Index('pg_endogenous_membership_member', 'session_code', 'member'),
+       Index('pg_endogenous_membership_owner', 'session_code', 'owner'),
+   )
+
+
+
+
+class BoardSnapshot(ExtraModel):
+   # the formation board (employer / pending / accepted) over time: a full
+   # keyframe every few snapshots, otherwise only the entries that changed
+   subsession = models.Link(Subsession)
+   session_code = models.StringField()
+   round_number = models.IntegerField()
+   seq = models.IntegerField()
+   created = models.FloatField()      # unix time
+   rev = models.IntegerField()
+   keyframe = models.BooleanField()
+   data = models.LongStringField()    # JSON board (keyframe) or delta
+
+   __table_args__ = (
+       Index('pg_endogenous_boardsnapshot_seq', 'session_code', 'round_number', 'seq'),
+   )
+
+
 def total_points_so_far(player: Player) -> float:
     total = 0.0
     for r in range(1, player.round_number):
@@ -99,12 +199,18 @@ def _initial_state(n_players: int):
        accepted={o: [] for o in owners},     # owner -> [employee ids]
        employer={str(i): None for i in range(1, n_players + 1)},  # person -> owner id (or None)
        rejections=[],
+       rev=0,                                # bumped on every change
+       versions={o: 0 for o in owners},      # owner -> bumped when that firm card changes
    )
 
 
 
 
 def _get_state(subsession: Subsession):
+   raw = backends.get_backend().load(_cache_key(subsession))
+   if raw is not None and raw != subsession.formation_state:
+       # another worker process moved this market on (shared backend only)
+       subsession.formation_state = raw
    if not subsession.formation_state:
        state = _initial_state(len(subsession.get_players()))
        subsession.formation_state = json.dumps(state)
@@ -116,6 +222,20 @@ def _get_state(subsession: Subsession):
 
 def _set_state(subsession: Subsession, state):
    subsession.formation_state = json.dumps(state)
+   backends.get_backend().store(_cache_key(subsession), subsession.formation_state)
+
+
+
+
+def formation_seconds_left(player: Player) -> float:
+   # Each player gets the full formation_seconds from the moment they first
+   # see Formation (a slow reader is not cut short by the first arrival). The
+   # deadline is stored on the player, so a reload or server restart resumes
+   # the countdown instead of starting it over.
+   if not player.formation_deadline:
+       seconds = player.session.config.get('formation_seconds', C.FORMATION_SECONDS)
+       player.formation_deadline = time.time() + seconds
+   return max(0, player.formation_deadline - time.time())
 
 
 
@@ -137,29 +257,67 @@ def _auto_reject_incoming_if_owner_becomes_inactive(state, owner_id: int):
        state['pending'][owner_s] = []
 
 
-def _resumes_for_all(subsession: Subsession):
+# Per-process caches keyed by (session code, round number). They only hold data
+# that can be rebuilt from the database, so losing them (server restart) just
+# means the next call rebuilds.
+_RESUME_CACHE = {}
+_PAYLOAD_CACHE = {}
+# (session code, round number, player id) -> OrderedDict(msg_id -> response)
+_DEDUP = {}
+
+
+def _cache_key(subsession: Subsession):
+   return (subsession.session.code, subsession.round_number)
+
+
+def _evict_before(session_code, round_number):
+   for cache in (_RESUME_CACHE, _PAYLOAD_CACHE, _DEDUP):
+       for key in [k for k in cache if k[0] == session_code and k[1] < round_number]:
+           del cache[key]
+   backends.get_backend().drop_before(session_code, round_number)
+
+
+def _resume_row(p: Player):
+   return dict(
+       round=p.round_number,
+       firm_owner_id=p.firm_owner_id,
+       firm_size=p.firm_size,
+       firm_members=p.firm_members,
+       tenure=p.tenure_with_owner,
+       per_capita_effort=p.firm_per_capita_effort,
+       per_capita_payout=p.firm_per_capita_payout,
+       was_terminated=p.was_terminated,
+   )
+
+
+def _build_resumes(subsession: Subsession):
    out = {}
    for p in subsession.get_players():
-       hist = []
-       for pr in p.in_previous_rounds():
-           hist.append(dict(
-               round=pr.round_number,
-               firm_owner_id=pr.firm_owner_id,
-               firm_size=pr.firm_size,
-               firm_members=pr.firm_members,
-               per_capita_effort=pr.firm_per_capita_effort,
-               per_capita_payout=pr.firm_per_capita_payout,
-               was_terminated=pr.was_terminated,
-           ))
-       out[str(p.id_in_subsession)] = hist
+       out[str(p.id_in_subsession)] = [_resume_row(pr) for pr in p.in_previous_rounds()]
    return out
 
 
+def _resumes_for_all(subsession: Subsession, n: int = None):
+   key = _cache_key(subsession)
+   resumes = _RESUME_CACHE.get(key)
+   if resumes is None:
+       if subsession.resume_snapshot:
+           resumes = json.loads(subsession.resume_snapshot)
+       elif subsession.round_number == 1 and n is not None:
+           # nobody has a history yet
+           resumes = {str(i): [] for i in range(1, n + 1)}
+       else:
+           resumes = _build_resumes(subsession)
+       _RESUME_CACHE[key] = resumes
+   return resumes
+
+
 
 
 def _build_payload(subsession: Subsession, state):
-   players = subsession.get_players()
-   n = len(players)
+   # everything comes from the state and the subsession row (no Player
+   # rows), so the first payload after a server restart is one read away
+   n = len(state["employer"])
 
 
    # ✅ create payload dict FIRST
@@ -167,8 +325,8 @@ def _build_payload(subsession: Subsession, state):
 
 
    # ✅ add resume/history info for UI
-   payload["resumes"] = _resumes_for_all(subsession)
-   payload["all_ids"] = [p.id_in_subsession for p in players]
+   payload["resumes"] = _resumes_for_all(subsession, n)
+   payload["all_ids"] = list(range(1, n + 1))
 
 
    # outgoing applications: for each applicant id -> list of owners they applied to
@@ -178,6 +336,7 @@ def _build_payload(subsession: Subsession, state):
            outgoing[str(a)].append(int(owner_s))
 
 
+   versions = state.get("versions", {})
    firms = []
    for owner in range(1, n + 1):
        owner_s = str(owner)
@@ -198,36 +357,80 @@ def _build_payload(subsession: Subsession, state):
            members=members,
            pending=pending,
            slots_left=slots_left,
+           version=versions.get(owner_s, 0),
        ))
 
 
+   payload["rev"] = state.get("rev", 0)
    payload["firms"] = firms
    payload["employer"] = state["employer"]
    payload["outgoing"] = outgoing
    return payload
 
 
+def _payload_for(subsession: Subsession, state):
+   """
+   Payload for the stored state. `state` must be what subsession.formation_state
+   holds (i.e. loaded from it or just saved with _set_state), so the serialized
+   state doubles as the cache key and repeated pings cost one string compare.
+   """
+   key = _cache_key(subsession)
+   cached = _PAYLOAD_CACHE.get(key)
+   if cached is not None and cached[0] == subsession.formation_state:
+       return cached[1]
+   payload = _build_payload(subsession, state)
+   _PAYLOAD_CACHE[key] = (subsession.formation_state, payload)
+   return payload
+
+
+def prewarm_next_round(subsession: Subsession):
+   """
+   Runs once all groups are paid, while everyone sits on Results/Relay.
+   Builds next round's resume snapshot (this round's snapshot + one row per
+   player), its formation state and the first payload, so the opening burst
+   of Formation pings is served from cache.
+   """
+   if subsession.round_number >= C.NUM_ROUNDS:
+       return
+   nxt = subsession.in_round(subsession.round_number + 1)
+   state = _get_state(subsession)
+
+   # finalize_formation may have marked last round's rows as terminated
+   terminated = set(state.get('terminated', []))
+   resumes = {}
+   for pid_s, hist in _resumes_for_all(subsession).items():
+       hist = list(hist)
+       if hist and int(pid_s) in terminated:
+           hist[-1] = dict(hist[-1], was_terminated=True)
+       resumes[pid_s] = hist
+   for p in subsession.get_players():
+       resumes[str(p.id_in_subsession)].append(_resume_row(p))
+
+   nxt.resume_snapshot = json.dumps(resumes)
+   _evict_before(subsession.session.code, nxt.round_number)
+   _RESUME_CACHE[_cache_key(nxt)] = resumes
+   _payload_for(nxt, _get_state(nxt))
+
+
 # ---------------------------
 # Session setup
 # ---------------------------
 
 
 def creating_session(subsession: Subsession):
-   players = subsession.get_players()
-
+   # Nothing is prepared per round here. oTree already creates every round
+   # with one big group (PLAYERS_PER_GROUP = None), which is what formation
+   # needs, and _get_state builds a round's formation state on first use
+   # (prewarm_next_round does so while the previous round is on Results).
+   # So only round 1 does any work, and session creation stays fast.
+   if subsession.round_number != 1:
+       return
 
    # real sessions: must be 18; test sessions can be smaller
    test_mode = subsession.session.config.get('test_mode', False)
-   if (not test_mode) and len(players) != 18:
-       raise Exception(f"T3/T4 require exactly 18 participants; currently {len(players)}")
-
-
-   # one big group during formation
-   subsession.set_group_matrix([players])
-
-
-   subsession.formation_state = json.dumps(_initial_state(len(players)))
-   subsession.formation_finalized = False
+   num_players = len(subsession.session.get_participants())
+   if (not test_mode) and num_players != 18:
+       raise Exception(f"T3/T4 require exactly 18 participants; currently {num_players}")
 
 
 
@@ -241,83 +444,73 @@ def creating_session(subsession: Subsession):
 
 
 
-def live_formation(player: Player, data):
-   subsession = player.subsession
-   state = _get_state(subsession)
-   players = subsession.get_players()
-   n = len(players)
+def _as_id(value):
+   # a player id from the client: an int or a string of digits, else None
+   if isinstance(value, int) and not isinstance(value, bool):
+       return value
+   if isinstance(value, str) and value.isdigit():
+       return int(value)
+   return None
 
 
-   pid = player.id_in_subsession
+def _apply_action(state, pid: int, n: int, data):
+   """
+   Validate and apply one apply/withdraw/accept/reject action by player `pid`.
+   Returns an error message (state untouched) or None on success.
+   """
    msg_type = data.get('type')
-
-
-   def deny(msg):
-       # IMPORTANT: do NOT return key 0 together with other keys
-       return {
-           player.id_in_group: dict(
-               alert=msg,
-               state=_build_payload(subsession, state),
-           )
-       }
-
-
-   if msg_type == 'ping':
-       return {player.id_in_group: dict(state=_build_payload(subsession, state))}
-
-
    employer = state['employer']
    pending = state['pending']
    accepted = state['accepted']
 
 
    if msg_type == 'apply':
-       owner = int(data.get('owner', 0))
-       if owner <= 0 or owner > n:
-           return deny("Invalid firm.")
+       owner = _as_id(data.get('owner', 0))
+       if owner is None or owner <= 0 or owner > n:
+           return "Invalid firm."
        if owner == pid:
-           return deny("You cannot apply to your own firm.")
+           return "You cannot apply to your own firm."
        if employer[str(pid)] is not None:
-           return deny("You are already employed; acceptance is binding.")
+           return "You are already employed; acceptance is binding."
        if len(accepted[str(pid)]) > 0:
-           return deny("You have hired someone, so you can no longer apply elsewhere.")
+           return "You have hired someone, so you can no longer apply elsewhere."
        if employer[str(owner)] is not None:
-           return deny("That firm is inactive (owner is employed elsewhere).")
+           return "That firm is inactive (owner is employed elsewhere)."
        if 1 + len(accepted[str(owner)]) >= C.MAX_FIRM_SIZE:
-           return deny("That firm is full.")
+           return "That firm is full."
        if pid in pending[str(owner)]:
-           return deny("You already applied to that firm.")
+           return "You already applied to that firm."
        pending[str(owner)].append(pid)
 
 
    elif msg_type == 'withdraw':
-       owner = int(data.get('owner', 0))
-       if owner <= 0 or owner > n:
-           return deny("Invalid firm.")
+       owner = _as_id(data.get('owner', 0))
+       if owner is None or owner <= 0 or owner > n:
+           return "Invalid firm."
        if employer[str(pid)] is not None:
-           return deny("You cannot withdraw after being accepted.")
+           return "You cannot withdraw after being accepted."
        if pid not in pending[str(owner)]:
-           return deny("No pending application to withdraw.")
+           return "No pending application to withdraw."
        pending[str(owner)].remove(pid)
 
 
    elif msg_type == 'accept':
-       owner = int(data.get('owner', 0))
-       applicant = int(data.get('applicant', 0))
+       owner = _as_id(data.get('owner', 0))
+       applicant = _as_id(data.get('applicant', 0))
 
 
        if owner != pid:
-           return deny("Only the firm owner can accept applicants to this firm.")
+           return "Only the firm owner can accept applicants to this firm."
        if employer[str(owner)] is not None:
-           return deny("Your firm is inactive because you are employed elsewhere.")
+           return "Your firm is inactive because you are employed elsewhere."
        if applicant not in pending[str(owner)]:
-           return deny("That application is not pending.")
+           return "That application is not pending."
        if employer[str(applicant)] is not None:
-           return deny("Applicant is already employed elsewhere.")
+           return "Applicant is already employed elsewhere."
        if len(accepted[str(applicant)]) > 0:
-           return deny("Applicant cannot join because they already hired someone.")
+           return "Applicant cannot join because they already hired someone."
        if 1 + len(accepted[str(owner)]) >= C.MAX_FIRM_SIZE:
-           return deny("Your firm is full.")
+           return "Your firm is full."
 
 
        pending[str(owner)].remove(applicant)
@@ -334,14 +527,14 @@ def live_formation(player: Player, data):
 
 
    elif msg_type == 'reject':
-       owner = int(data.get('owner', 0))
-       applicant = int(data.get('applicant', 0))
+       owner = _as_id(data.get('owner', 0))
+       applicant = _as_id(data.get('applicant', 0))
 
 
        if owner != pid:
-           return deny("Only the firm owner can reject applicants to this firm.")
+           return "Only the firm owner can reject applicants to this firm."
        if applicant not in pending[str(owner)]:
-           return deny("That application is not pending.")
+           return "That application is not pending."
 
 
        pending[str(owner)].remove(applicant)
@@ -352,49 +545,321 @@ def live_formation(player: Player, data):
 
 
    else:
-       return deny("Unknown action.")
+       return "Unknown action."
+
+
+
+
+def _firm_signatures(state):
+   # everything a firm card shows: active flag, employees, pending applicants
+   return {
+       owner_s: (state['employer'][owner_s] is None,
+                 tuple(state['accepted'][owner_s]),
+                 tuple(state['pending'][owner_s]))
+       for owner_s in state['pending']
+   }
+
+
+def _bump_versions(state, before):
+   """Bump the version of every firm whose card changed, and the board revision."""
+   versions = state.setdefault('versions', {})
+   changed = False
+   for owner_s, signature in _firm_signatures(state).items():
+       if before.get(owner_s) != signature:
+           versions[owner_s] = versions.get(owner_s, 0) + 1
+           changed = True
+   if changed:
+       state['rev'] = state.get('rev', 0) + 1
+
+
+
+
+def _expand_batch(state, pid: int, data):
+   """
+   Turn a batch message into the list of single actions it stands for:
+     apply_many  {owners: [...]}               -> apply to each owner
+     accept_many {owner, applicants: [...]}    -> accept each applicant
+     reject_all  {owner}                       -> reject every pending applicant
+     batch       {actions: [...]}              -> any mix of single actions
+   Returns None if the message is malformed (a list that is not a list, an
+   action that is not a dict, an owner that is not an id).
+   """
+   msg_type = data.get('type')
+   if msg_type == 'apply_many':
+       owners = data.get('owners') or []
+       if not isinstance(owners, list):
+           return None
+       return [dict(type='apply', owner=o) for o in owners]
+   if msg_type == 'accept_many':
+       owner = _as_id(data.get('owner', pid))
+       applicants = data.get('applicants') or []
+       if owner is None or not isinstance(applicants, list):
+           return None
+       return [dict(type='accept', owner=owner, applicant=a) for a in applicants]
+   if msg_type == 'reject_all':
+       owner = _as_id(data.get('owner', pid))
+       if owner is None:
+           return None
+       pending = state['pending'].get(str(owner), [])
+       return [dict(type='reject', owner=owner, applicant=a) for a in pending]
+   actions = data.get('actions') or []
+   if not isinstance(actions, list) or not all(isinstance(a, dict) for a in actions):
+       return None
+   return list(actions)
+
+
+BATCH_TYPES = ('apply_many', 'accept_many', 'reject_all', 'batch')
+
+
+
+
+def _apply_message(state, pid: int, n: int, data):
+   """
+   Apply one single or batch action message by player `pid` (no database).
+   Returns (state, None) on success, with versions/rev bumped, or
+   (state, error message) with the state left as it was.
+   """
+   before = _firm_signatures(state)
+
+   if data.get('type') in BATCH_TYPES:
+       actions = _expand_batch(state, pid, data)
+       if actions is None:
+           return state, "Unknown action."
+       if not actions:
+           return state, "Nothing to do."
+       if len(actions) > n:
+           return state, "Too many actions in one message."
+
+       # all-or-nothing: work on a copy and only keep it if every action is valid
+       new_state = json.loads(json.dumps(state))
+       for i, action in enumerate(actions, start=1):
+           if action.get('type') in BATCH_TYPES or action.get('type') == 'ping':
+               return state, "Unknown action."
+           error = _apply_action(new_state, pid, n, action)
+           if error:
+               if len(actions) > 1:
+                   error = f"Action {i} of {len(actions)}: {error} Nothing was changed."
+               return state, error
+       state = new_state
+
+   else:
+       error = _apply_action(state, pid, n, data)
+       if error:
+           return state, error
+
+   _bump_versions(state, before)
+   return state, None
+
+
+
+
+def _seen_responses(subsession: Subsession, pid: int):
+   key = _cache_key(subsession) + (pid,)
+   seen = _DEDUP.get(key)
+   if seen is None:
+       seen = _DEDUP[key] = OrderedDict()
+   return seen
+
+
+def _remember_response(seen, msg_id, response):
+   seen[msg_id] = response
+   seen.move_to_end(msg_id)
+   while len(seen) > C.DEDUP_WINDOW:
+       seen.popitem(last=False)
+
+
+def live_formation(player: Player, data):
+   # Actions carry a client-generated msg_id. A repeated id (a resend of
+   # the same message) gets the earlier response replayed to the sender only,
+   # without validating or building a payload again.
+   if not isinstance(data, dict):
+       return {player.id_in_group: dict(alert="Unknown action.")}
+   if data.get('type') == 'ping':
+       return _handle_formation_message(player, data)
+
+   # Changes to one market are applied one at a time (a no-op with the
+   # default in-process backend, where oTree already serializes live methods).
+   with backends.get_backend().lock(_cache_key(player.subsession)):
+       msg_id = data.get('msg_id')
+       if not msg_id:
+           return _handle_formation_message(player, data)
+       # only str / int ids are remembered (a list or dict is not hashable)
+       if isinstance(msg_id, bool) or not isinstance(msg_id, (str, int)):
+           return {player.id_in_group: dict(alert="Invalid message id.")}
+
+       seen = _seen_responses(player.subsession, player.id_in_subsession)
+       if msg_id in seen:
+           seen.move_to_end(msg_id)
+           return {player.id_in_group: seen[msg_id]}
+
+       response = _handle_formation_message(player, data)
+       _remember_response(seen, msg_id, response.get(0, response.get(player.id_in_group)))
+       return response
+
+
+def _relay_watch(player: Player, state):
+   # shared backends only: push other workers' changes to this worker's pages
+   if backends.get_backend().shared:
+       participant = player.participant
+       relay.watch(_cache_key(player.subsession), player.session.code,
+                   participant._index_in_pages, participant.code, state.get('rev', 0))
+
+
+
+
+def _handle_formation_message(player: Player, data):
+   started = time.perf_counter()
+   subsession = player.subsession
+   state = _get_state(subsession)
+   n = len(state['employer'])
+
+
+   pid = player.id_in_subsession
+   msg_type = data.get('type')
+   _relay_watch(player, state)
+   monitor.note(_cache_key(subsession), subsession.formation_state)
+
 
+   def deny(msg):
+       # IMPORTANT: do NOT return key 0 together with other keys
+       # msg_id is echoed so a client can tell which of its messages was denied
+       return {
+           player.id_in_group: dict(
+               alert=msg,
+               msg_id=data.get('msg_id'),
+               state=_payload_for(subsession, state),
+           )
+       }
 
+
+   if msg_type == 'ping':
+       # the client already shows this revision: nothing to send
+       if data.get('since') is not None and data['since'] == state.get('rev', 0):
+           return None
+       return {player.id_in_group: dict(state=_payload_for(subsession, state))}
+
+
+   before = _board_before(subsession, state)
+   state, error = _apply_message(state, pid, n, data)
+   if error:
+       return deny(error)
+
+   _record_board(subsession, state, before=before)
    _set_state(subsession, state)
-   return {0: dict(state=_build_payload(subsession, state))}
+   _relay_watch(player, state)
+   monitor.note(_cache_key(subsession), subsession.formation_state)
+   payload = _payload_for(subsession, state)
+   # ms: server time to validate, store and build the broadcast (experimenter monitor)
+   backends.get_backend().publish(
+       _cache_key(subsession),
+       dict(rev=state['rev'], type=msg_type, player=pid,
+            ms=round((time.perf_counter() - started) * 1000, 2)),
+   )
+   return {0: dict(state=payload)}
 
 
 
 
 # ---------------------------
-# Finalize + regroup
+# Experimenter monitor (admin report)
 # ---------------------------
+# The Reports tab (admin_report.html) opens a websocket to
+# /formation_monitor/<session code>; monitor.py pushes monitor_data() of the
+# session's current market to it whenever that market changes (at most once
+# a second). live_formation and finalize_formation note the market they work
+# on (monitor.note), so the monitor follows the round being played, not the
+# next round that prewarm_next_round has already prepared.
+MONITOR_RECENT_EVENTS = 25
+
+
+def _percentile(values, q):
+   values = sorted(values)
+   return values[int(q * (len(values) - 1))]
+
+
+def monitor_data(round_number: int, state, events):
+   """What the monitor shows of one market: its state and event stream (see backends)."""
+
+   employer, pending, accepted = state['employer'], state['pending'], state['accepted']
+   versions = state.get('versions', {})
+   firms = [
+       dict(owner=int(o), size=1 + len(accepted[o]), members=accepted[o], pending=pending[o],
+            slots_left=C.MAX_FIRM_SIZE - 1 - len(accepted[o]), version=versions.get(o, 0))
+       for o in employer
+       if employer[o] is None and (accepted[o] or pending[o])
+   ]
+   hiring = {f['owner'] for f in firms if f['size'] > 1}
+   outgoing = {o: [] for o in employer}
+   for o, applicants in pending.items():
+       for a in applicants:
+           outgoing[str(a)].append(int(o))
+   seekers = [
+       dict(player=int(p), applied_to=owners)
+       for p, owners in outgoing.items()
+       if employer[p] is None and int(p) not in hiring
+   ]
+
+   now = time.time()
+   latencies = [e['ms'] for e in events if e.get('ms') is not None]
+   by_type = {}
+   for e in events:
+       by_type[e['type']] = by_type.get(e['type'], 0) + 1
+   recent = [
+       dict(rev=e['rev'], type=e['type'], player=e['player'],
+            ago=f"{now - e['t']:.1f}", ms=e.get('ms', ''))
+       for e in reversed(events[-MONITOR_RECENT_EVENTS:])
+   ]
 
+   return dict(
+       open=True,
+       round=round_number,
+       rev=state.get('rev', 0),
+       num_players=len(employer),
+       num_employed=sum(1 for e in employer.values() if e is not None),
+       firms=firms,
+       seekers=seekers,
+       events_kept=len(events),
+       actions_by_type=', '.join(f"{t} {n}" for t, n in sorted(by_type.items())),
+       rate_10s=f"{sum(1 for e in events if now - e['t'] <= 10) / 10:.1f}",
+       rate_60s=f"{sum(1 for e in events if now - e['t'] <= 60) / 60:.1f}",
+       latency_p50=f"{_percentile(latencies, 0.5):.1f}" if latencies else '-',
+       latency_p95=f"{_percentile(latencies, 0.95):.1f}" if latencies else '-',
+       latency_max=f"{max(latencies):.1f}" if latencies else '-',
+       recent_events=recent,
+   )
+
+
+monitor.register(monitor_data)
+
+
+def vars_for_admin_report(subsession: Subsession):
+   return dict(monitor_session_code=subsession.session.code, monitor_available=monitor.available())
 
-def finalize_formation(group: Group):
-   subsession = group.subsession
-   state = _get_state(subsession)
-   players = subsession.get_players()
-   n = len(players)
 
 
-   players_by_id = {p.id_in_subsession: p for p in players}
 
+# ---------------------------
+# Finalize + regroup
+# ---------------------------
 
+
+def _formation_matrix(state, n: int):
+   """
+   Close the market in `state` and return (matrix of player ids, operating
+   owners). Firms come first, owner at index 0; everyone else is a
+   singleton. Pure, so the fuzzer can run it without a database.
+   """
    # ------------------------------------------------------------
    # 1) Auto-reject any remaining pending applications at the end
    # ------------------------------------------------------------
+   signatures = _firm_signatures(state)
    for owner_s, apps in state['pending'].items():
        owner = int(owner_s)
        for a in list(apps):
            state['rejections'].append(dict(applicant=a, owner=owner, reason='auto_end'))
        state['pending'][owner_s] = []
-
-
-   # ------------------------------------------------------------
-   # 2) Default everyone to autarky (singleton) until proven otherwise
-   # ------------------------------------------------------------
-   for p in players:
-       p.is_autarkic = True
-       p.firm_owner_id = 0
-       p.employer_id = 0
-       # (current round termination flag should remain default False;
-       #  we mark termination on the PREVIOUS round row when relevant)
+   # closing is a change like any other (the board recorder keys rows by rev)
+   _bump_versions(state, signatures)
 
 
    matrix = []
@@ -406,7 +871,7 @@ def finalize_formation(group: Group):
 
 
    # ------------------------------------------------------------
-   # 3) Create firms for "active owners" (owners NOT employed elsewhere)
+   # 2) Create firms for "active owners" (owners NOT employed elsewhere)
    #    A firm only exists if the owner has >=1 accepted employee (size>=2)
    # ------------------------------------------------------------
    for owner in range(1, n + 1):
@@ -427,59 +892,74 @@ def finalize_formation(group: Group):
 
 
        operating_owners.add(owner)
+       member_ids = [owner] + employees
+       matrix.append(member_ids)
+       assigned.update(member_ids)
 
 
-       member_ids = [owner] + employees
-       matrix.append([players_by_id[i] for i in member_ids])
+   # ------------------------------------------------------------
+   # 3) Everyone not assigned goes to autarky singleton group
+   # ------------------------------------------------------------
+   for pid in range(1, n + 1):
+       if pid not in assigned:
+           matrix.append([pid])
 
 
-       for pid in member_ids:
-           assigned.add(pid)
-           p = players_by_id[pid]
-           p.is_autarkic = False
-           p.firm_owner_id = owner
+   return matrix, operating_owners
 
 
-           # employer_id: employees point to owner; owner has employer_id=0
-           if pid == owner:
-               p.employer_id = 0
-           else:
-               p.employer_id = owner
+
+
+def finalize_formation(subsession: Subsession):
+   state = _get_state(subsession)
+   before = _board_before(subsession, state)
+   players = subsession.get_players()
+   n = len(players)
+
+
+   players_by_id = {p.id_in_subsession: p for p in players}
 
 
    # ------------------------------------------------------------
-   # 4) Everyone not assigned goes to autarky singleton group
+   # 1) - 3) Close the market and work out the partition
    # ------------------------------------------------------------
-   for pid, p in players_by_id.items():
-       if pid not in assigned:
-           matrix.append([p])
-           p.is_autarkic = True
-           p.firm_owner_id = 0
-           p.employer_id = 0
+   id_matrix, operating_owners = _formation_matrix(state, n)
+   matrix = []
+   for member_ids in id_matrix:
+       matrix.append([players_by_id[i] for i in member_ids])
+       owner = member_ids[0] if len(member_ids) > 1 else 0
+       for pid in member_ids:
+           p = players_by_id[pid]
+           p.is_autarkic = owner == 0
+           p.firm_owner_id = owner
+           # employer_id: employees point to owner; owners and autarky have 0
+           p.employer_id = owner if pid != owner else 0
+           # (current round termination flag should remain default False;
+           #  we mark termination on the PREVIOUS round row when relevant)
 
 
    # Apply the grouping for this round
    subsession.set_group_matrix(matrix)
+   _record_memberships(subsession, matrix)
 
 
    # ------------------------------------------------------------
-   # 5) TERMINATION: mark previous round if rejected by prior employer
+   # 4) TERMINATION: mark previous round if rejected by prior employer
    #    AND the employer continues operating this period
    # ------------------------------------------------------------
+   history = _load_history(subsession)
+   terminated = []
+   terminated_pairs = set()  # avoid double-marking (applicant, owner)
    if subsession.round_number > 1:
-       seen_pairs = set()  # avoid double-marking (applicant, owner)
-
-
        for r in state.get('rejections', []):
            applicant = int(r.get('applicant', 0))
            owner = int(r.get('owner', 0))
 
 
-           if applicant <= 0 or owner <= 0:
+           if applicant <= 0 or owner <= 0 or applicant not in players_by_id:
                continue
-           if (applicant, owner) in seen_pairs:
+           if (applicant, owner) in terminated_pairs:
                continue
-           seen_pairs.add((applicant, owner))
 
 
            # Only count as "termination" if the owner is operating this period
@@ -488,20 +968,350 @@ def finalize_formation(group: Group):
 
 
            # Check if applicant worked for this owner LAST period
-           app_p_current = players_by_id.get(applicant)
-           if not app_p_current:
+           if not _employed_last_round(history, owner, applicant, subsession.round_number):
                continue
 
 
-           prev_p = app_p_current.in_round(subsession.round_number - 1)
+           terminated_pairs.add((applicant, owner))
+           players_by_id[applicant].in_round(subsession.round_number - 1).was_terminated = True
+           terminated.append(applicant)
 
+   _update_history(history, subsession.round_number, state, operating_owners, terminated_pairs)
+   subsession.employment_history = json.dumps(history)
+   _set_turnover_fields(players, history)
 
-           if (not prev_p.is_autarkic) and (prev_p.firm_owner_id == owner):
-               prev_p.was_terminated = True
+
+   # Save state (rejections list etc.); prewarm_next_round reads 'terminated'
+   state['terminated'] = terminated
+   with backends.get_backend().lock(_cache_key(subsession)):
+       _record_board(subsession, state, before=before, force=True)
+       _set_state(subsession, state)
+   monitor.note(_cache_key(subsession), subsession.formation_state)
+
+
+
+
+# ---------------------------
+# Employment history
+# ---------------------------
+# Cumulative (owner, worker) index, one JSON copy per round:
+#   pairs['owner,worker'] = dict(first, last, rounds, spell, terminations)
+#       spell = consecutive rounds ending at `last`
+#   owners['owner'] = dict(operated, hires, terminations)
+#       hires counts spells started, not distinct workers
+#   workers['worker'] = dict(employers, terminated)
+
+
+def _empty_history():
+   return dict(pairs={}, owners={}, workers={})
+
+
+
+
+def _pair_key(owner: int, worker: int):
+   return f"{owner},{worker}"
+
+
+
+
+def _load_history(subsession: Subsession):
+   # the previous round's copy, so one in_round() call per finalize
+   if subsession.round_number == 1:
+       return _empty_history()
+   raw = subsession.in_round(subsession.round_number - 1).employment_history
+   return json.loads(raw) if raw else _empty_history()
+
+
+
+
+def _employed_last_round(history, owner: int, worker: int, round_number: int):
+   pair = history['pairs'].get(_pair_key(owner, worker))
+   return pair is not None and pair['last'] == round_number - 1
+
+
+
+
+def _update_history(history, round_number: int, state, operating_owners, terminated_pairs):
+   for applicant, owner in terminated_pairs:
+       history['pairs'][_pair_key(owner, applicant)]['terminations'] += 1
+       history['owners'][str(owner)]['terminations'] += 1
+       history['workers'][str(applicant)]['terminated'] += 1
+
+   for owner in operating_owners:
+       owner_stats = history['owners'].setdefault(
+           str(owner), dict(operated=0, hires=0, terminations=0))
+       owner_stats['operated'] += 1
+       for worker in state['accepted'][str(owner)]:
+           key = _pair_key(owner, worker)
+           pair = history['pairs'].get(key)
+           worker_stats = history['workers'].setdefault(
+               str(worker), dict(employers=0, terminated=0))
+           if pair is None:
+               pair = history['pairs'][key] = dict(
+                   first=round_number, last=None, rounds=0, spell=0, terminations=0)
+               worker_stats['employers'] += 1
+           if pair['last'] is not None and pair['last'] == round_number - 1:
+               pair['spell'] += 1
+           else:
+               pair['spell'] = 1
+               owner_stats['hires'] += 1
+           pair['last'] = round_number
+           pair['rounds'] += 1
+
+
+
+
+def _set_turnover_fields(players, history):
+   for p in players:
+       pid = str(p.id_in_subsession)
+       if p.employer_id:
+           p.tenure_with_owner = history['pairs'][_pair_key(p.employer_id, p.id_in_subsession)]['spell']
+       else:
+           p.tenure_with_owner = 0
+       p.terminations_made = history['owners'].get(pid, {}).get('terminations', 0)
+       worker_stats = history['workers'].get(pid, {})
+       p.times_terminated = worker_stats.get('terminated', 0)
+       p.employers_so_far = worker_stats.get('employers', 0)
+
+
+
+
+def employment_history(subsession: Subsession):
+   """The cumulative (owner, worker) index as of this (finalized) round."""
+   raw = subsession.employment_history
+   return json.loads(raw) if raw else _empty_history()
+
+
+
+
+# ---------------------------
+# Membership table
+# ---------------------------
+
+
+def _record_memberships(subsession: Subsession, matrix):
+   # firm groups come first in the matrix with the owner at index 0; autarky
+   # singletons are skipped
+   session_code = subsession.session.code
+   for members in matrix:
+       if len(members) < 2:
+           continue
+       owner = members[0].id_in_subsession
+       for p in members:
+           Membership.create(
+               subsession=subsession,
+               session_code=session_code,
+               round_number=subsession.round_number,
+               owner=owner,
+               member=p.id_in_subsession,
+           )
+
+
+
+
+# ExtraModel.filter() insists on a model-instance kwarg, which would rule out
+# the (session_code, member) / (session_code, owner) indexes, so these helpers
+# go through objects_filter.
+def rounds_together(session_code: str, a: int, b: int):
+   """Rounds in which players a and b worked in the same firm."""
+   firms_a = {
+       (m.round_number, m.owner)
+       for m in Membership.objects_filter(session_code=session_code, member=a)
+   }
+   return sorted(
+       m.round_number
+       for m in Membership.objects_filter(session_code=session_code, member=b)
+       if (m.round_number, m.owner) in firms_a
+   )
+
+
+
+
+def rounds_with_owner(session_code: str, member: int, owner: int):
+   """Rounds in which member belonged to owner's firm (owner's own rounds included)."""
+   return sorted(
+       m.round_number
+       for m in Membership.objects_filter(session_code=session_code, member=member, owner=owner)
+   )
+
+
+
+
+def firm_roster(session_code: str, owner: int):
+   """round_number -> sorted member ids for every round owner's firm operated."""
+   out = {}
+   for m in Membership.objects_filter(session_code=session_code, owner=owner):
+       out.setdefault(m.round_number, []).append(m.member)
+   return {r: sorted(ms) for r, ms in sorted(out.items())}
+
+
+# ---------------------------
+# Board snapshots
+# ---------------------------
+# The board is written to BoardSnapshot when it changes, at most once per
+# `snapshot_seconds` (session config, 0 = off). A change that comes sooner is
+# held back; it is written, with its own time, in front of the next change
+# that is due, or when the market closes. So the board as of any moment is
+# known to within one cadence, and the closed board exactly.
+# Rows are numbered by the board revision (seq = rev). A row is a delta
+# against the row of the previous revision when that one was written, and a
+# keyframe otherwise and at every `snapshot_keyframe_every`-th revision, so
+# board_at() reads one keyframe and at most that many deltas.
+# The recorder keeps its bookkeeping in the formation state ('board_log': rev
+# and time of the last row written, time of the last change), and the row is
+# written by the worker that applies the change while it holds the market's
+# backend lock. So it works the same with a shared formation backend, and
+# carries on behind the rows already written after a restart.
+BOARD_PARTS = ('employer', 'pending', 'accepted')
+
+
+def _snapshot_seconds(subsession: Subsession):
+   return subsession.session.config.get('snapshot_seconds', C.SNAPSHOT_SECONDS)
+
+
+def _board(state):
+   return {part: state[part] for part in BOARD_PARTS}
+
+
+def _board_delta(old, new):
+   delta = {}
+   for part in BOARD_PARTS:
+       changed = {k: v for k, v in new[part].items() if old[part].get(k) != v}
+       if changed:
+           delta[part] = changed
+   return delta
+
+
+def _apply_board_delta(board, delta):
+   return {part: {**board[part], **delta.get(part, {})} for part in BOARD_PARTS}
+
+
+def _record_board_open(subsession: Subsession):
+   # the first participant to load Formation writes the opening keyframe
+   if not _snapshot_seconds(subsession) or subsession.formation_finalized:
+       return
+   if 'board_log' in _get_state(subsession):
+       return
+   with backends.get_backend().lock(_cache_key(subsession)):
+       state = _get_state(subsession)
+       if 'board_log' not in state:
+           _write_board(subsession, state, time.time(), state)
+           _set_state(subsession, state)
+
+
+def _board_before(subsession: Subsession, state):
+   # what _record_board needs of the state a change replaces (single actions
+   # change the state in place, so take a copy first)
+   if not _snapshot_seconds(subsession):
+       return None
+   return dict(json.loads(json.dumps(_board(state))), rev=state.get('rev', 0),
+               board_log=state.get('board_log'))
+
+
+def _record_board(subsession: Subsession, state, before=None, force=False):
+   """
+   Record `state` after a change (`before` = the state it replaced). At close
+   (`force`) the board is written whatever the cadence. Updates
+   state['board_log']; the caller stores the state.
+   """
+   if not _snapshot_seconds(subsession):
+       return
+   log = (before or state).get('board_log')
+   if log is None:
+       # nobody opened the page through js_vars (bots): start with the board
+       # as it was before this change
+       log = _write_board(subsession, state, time.time(), before or state)
+       if before is None:
+           return
+   rev = state.get('rev', 0)
+   if rev == log['rev']:
+       return  # nothing new since the last row
+   now = time.time()
+   if before is None or before.get('rev', 0) == rev:
+       # closing changed nothing: the held change is the closed board itself
+       _write_board(subsession, state, log['changed_at'], state)
+       return
+   if force or now - log['at'] >= _snapshot_seconds(subsession):
+       if log['rev'] < rev - 1:
+           _write_board(subsession, state, log['changed_at'], before)
+       _write_board(subsession, state, now, state, before=before)
+   state['board_log']['changed_at'] = now
+
+
+def _write_board(subsession: Subsession, state, created, board_state, before=None):
+   """
+   Write the board of `board_state` as one BoardSnapshot row: a delta against
+   `before` if that is the row just written, else a keyframe. Notes the row in
+   state['board_log'] and returns it.
+   """
+   every = subsession.session.config.get('snapshot_keyframe_every', C.SNAPSHOT_KEYFRAME_EVERY)
+   rev = board_state.get('rev', 0)
+   log = state.get('board_log')
+   keyframe = (
+       before is None or log is None or log['rev'] != before.get('rev', 0) or rev % every == 0
+   )
+   board = _board(board_state)
+   BoardSnapshot.create(
+       subsession=subsession,
+       session_code=subsession.session.code,
+       round_number=subsession.round_number,
+       seq=rev,
+       created=created,
+       rev=rev,
+       keyframe=keyframe,
+       data=json.dumps(board if keyframe else _board_delta(_board(before), board), separators=(',', ':')),
+   )
+   log = state['board_log'] = dict(rev=rev, at=created, changed_at=created)
+   return log
+
+
+def _board_rows(session_code: str, round_number: int, *args):
+   return BoardSnapshot.objects_filter(*args, session_code=session_code, round_number=round_number)
+
+
+def board_at(session_code: str, round_number: int, seconds: float):
+   """
+   (rev, board) as of `seconds` after the round's first snapshot, or None if
+   nothing was recorded. board = dict(employer, pending, accepted), keyed by
+   player id as str, like formation_state.
+   """
+   first = _board_rows(session_code, round_number).order_by(BoardSnapshot.seq).first()
+   if first is None:
+       return None
+   until = first.created + seconds
+   key = _board_rows(
+       session_code, round_number, BoardSnapshot.keyframe.is_(True), BoardSnapshot.created <= until
+   ).order_by(BoardSnapshot.seq.desc()).first() or first
+   board, rev = json.loads(key.data), key.rev
+   for row in _board_rows(
+       session_code, round_number, BoardSnapshot.seq > key.seq, BoardSnapshot.created <= until
+   ).order_by(BoardSnapshot.seq):
+       board, rev = _apply_board_delta(board, json.loads(row.data)), row.rev
+   return rev, board
+
+
+def board_series(session_code: str, round_number: int, step: float = 1.0):
+   """[(seconds, rev, board)] every `step` seconds from the first snapshot to the last."""
+   rows = list(_board_rows(session_code, round_number).order_by(BoardSnapshot.seq))
+   if not rows:
+       return []
+   t0 = rows[0].created
+   out = []
+   board = rev = None
+   i = 0
+   tick = 0.0
+   while True:
+       while i < len(rows) and rows[i].created <= t0 + tick:
+           data = json.loads(rows[i].data)
+           board = data if rows[i].keyframe else _apply_board_delta(board, data)
+           rev = rows[i].rev
+           i += 1
+       out.append((tick, rev, board))
+       if i == len(rows):
+           return out
+       tick += step
 
 
-   # Save state (rejections list etc.)
-   _set_state(subsession, state)
 
 
 # ---------------------------
@@ -532,6 +1342,8 @@ def set_payoffs(group: Group):
        group.total_effort = 0
        group.per_capita_effort = 0
        group.per_capita_payout = 0
+       group.total_effort_cents = 0
+       group.per_capita_payout_cents = 0
 
 
        # resume/history fields
@@ -545,6 +1357,7 @@ def set_payoffs(group: Group):
 
 
        # Paper: autarky earns 8 points
+       p.payoff_cents = C.ENDOWMENT * 100
        p.payoff = C.ENDOWMENT
        return
 
@@ -552,39 +1365,20 @@ def set_payoffs(group: Group):
    # -----------------
    # Firm (size >= 2)
    # -----------------
-   total_effort = sum(p.effort_to_firm for p in players)
-   group.total_effort = total_effort
-
-
-   per_capita_effort = total_effort / n
-   group.per_capita_effort = per_capita_effort
-
-
-   # IMPORTANT: make this strict so you can't accidentally run the wrong treatment
-   returns_type = group.session.config['returns_type']
-
-
-   if returns_type == 'constant':
-       # MPCR by size (2..6)
-       # Example: C.MPCR_BY_SIZE = {2:0.65, 3:0.55, 4:0.49, 5:0.45, 6:0.42}
-       if n not in C.MPCR_BY_SIZE:
-           raise Exception(f"No MPCR specified for firm size n={n}. Check C.MPCR_BY_SIZE.")
-       alpha = C.MPCR_BY_SIZE[n]
-       per_capita_payout = alpha * total_effort
+   # integer cents: sums are exact, payout is rounded once to the cent
+   total_effort_cents = sum(p.effort_cents for p in players)
+   payout_cents = payoffs.per_capita_payout_cents(group.session.config, C.MPCR_BY_SIZE, n, total_effort_cents)
 
 
-   elif returns_type == 'increasing':
-       # power production: output = a * E^b, shared equally
-       a = float(group.session.config['a'])
-       b = float(group.session.config['b'])
-       output = a * (total_effort ** b) if total_effort > 0 else 0.0
-       per_capita_payout = output / n
-
-
-   else:
-       raise Exception(f"Unknown returns_type: {returns_type}")
+   group.total_effort_cents = total_effort_cents
+   group.per_capita_payout_cents = payout_cents
 
 
+   total_effort = total_effort_cents / 100
+   per_capita_effort = total_effort / n
+   per_capita_payout = payout_cents / 100
+   group.total_effort = total_effort
+   group.per_capita_effort = per_capita_effort
    group.per_capita_payout = per_capita_payout
 
 
@@ -598,7 +1392,45 @@ def set_payoffs(group: Group):
 
 
        # payoff = endowment - effort + per-capita payout
-       p.payoff = (C.ENDOWMENT - p.effort_to_firm) + per_capita_payout
+       p.payoff_cents = C.ENDOWMENT * 100 - p.effort_cents + payout_cents
+       p.payoff = p.payoff_cents / 100
+
+
+def after_results(group: Group):
+   set_payoffs(group)
+
+   # the last group to finish triggers the pre-warm of next round's Formation
+   subsession = group.subsession
+   subsession.groups_paid += 1
+   if subsession.groups_paid == len(subsession.get_groups()):
+       record_efficiency(subsession)
+       prewarm_next_round(subsession)
+       if subsession.round_number == C.NUM_ROUNDS:
+           analytics.record_session(subsession)
+
+
+def record_efficiency(subsession: Subsession):
+   spec = benchmark.returns_spec(
+       subsession.session.config, C.MPCR_BY_SIZE, C.ENDOWMENT, C.MAX_FIRM_SIZE)
+   groups = subsession.get_groups()
+   result = benchmark.efficiency(
+       [g.firm_size for g in groups],
+       sum(p.payoff_cents for p in subsession.get_players()),
+       spec,
+   )
+   subsession.optimum_surplus = result['optimum_cents'] / 100
+   subsession.structure_efficiency = result['structure_efficiency']
+   subsession.realized_efficiency = result['realized_efficiency']
+
+   if subsession.round_number == C.NUM_ROUNDS:
+       rounds = subsession.in_all_rounds()
+       summary = dict(
+           optimal_sizes=list(result['optimal_sizes']),
+           mean_structure_efficiency=sum(s.structure_efficiency for s in rounds) / len(rounds),
+           mean_realized_efficiency=sum(s.realized_efficiency for s in rounds) / len(rounds),
+       )
+       subsession.session.vars['efficiency'] = summary
+       logger.info(f"Session {subsession.session.code} efficiency: {summary}")
 
 
 
@@ -621,18 +1453,18 @@ class Formation(Page):
        )
    @staticmethod
    def get_timeout_seconds(player: Player):
-       # let you shorten in test sessions
-       return player.session.config.get('formation_seconds', C.FORMATION_SECONDS)
+       # formation_seconds (session config) lets you shorten it in test sessions
+       return formation_seconds_left(player)
 
 
    @staticmethod
    def js_vars(player: Player):
+       # the first participant to load the page starts the board recording
+       _record_board_open(player.subsession)
        return dict(
        my_id=player.id_in_subsession,
        max_size=C.MAX_FIRM_SIZE,
-       formation_seconds=player.session.config.get(
-           'formation_seconds', C.FORMATION_SECONDS
-       )
+       seconds_left=formation_seconds_left(player),
    )
 
 
@@ -646,13 +1478,23 @@ class Formation(Page):
        subsession = player.subsession
        if not subsession.formation_finalized:
            subsession.formation_finalized = True
-           finalize_formation(player.group)
+           finalize_formation(subsession)
 
 
 
 
 class FormationWaitPage(WaitPage):
-   after_all_players_arrive = finalize_formation
+   # finalize_formation regroups everyone, and oTree marks a group-level wait
+   # page complete per group id, so the new groups would each finalize again.
+   # Wait for the whole subsession instead (once per round).
+   wait_for_all_groups = True
+
+
+   @staticmethod
+   def after_all_players_arrive(subsession: Subsession):
+       if not subsession.formation_finalized:
+           subsession.formation_finalized = True
+           finalize_formation(subsession)
 
 
    @staticmethod
@@ -691,35 +1533,42 @@ class Decision(Page):
    def is_displayed(player: Player):
        return len(player.group.get_players()) > 1
 
+   @staticmethod
+   def js_vars(player: Player):
+       return dict(preview=payoffs.payoff_preview(
+           player.session.config, C.MPCR_BY_SIZE, len(player.group.get_players()), C.ENDOWMENT))
+
    @staticmethod
    def before_next_page(player: Player, timeout_happened):
-       player.effort_to_firm = round(float(player.effort_to_firm or 0.0), 2)
+       # payoffs use the integer cents; the float is snapped to them
+       player.effort_cents = payoffs.to_cents(player.effort_to_firm)
+       player.effort_to_firm = player.effort_cents / 100
 
    @staticmethod
    def error_message(player: Player, values):
        x = values.get('effort_to_firm')
        if x is None:
            return
-       if abs(x - round(x, 2)) > 1e-9:
+       if abs(x * 100 - payoffs.to_cents(x)) > 1e-6:
            return "Please choose effort in increments of 0.01."
 
 
 class ResultsWaitPage(WaitPage):
     template_name = 'pg_endogenous/ResultsWaitPage.html'
-    after_all_players_arrive = set_payoffs
+    after_all_players_arrive = after_results
 
     @staticmethod
     def vars_for_template(player: Player):
         is_autarkic = len(player.group.get_players()) == 1
-        effort_to_firm = float(player.effort_to_firm or 0.0)
-        effort_kept = C.ENDOWMENT if is_autarkic else (C.ENDOWMENT - effort_to_firm)
+        effort_cents = 0 if is_autarkic else player.effort_cents
+        effort_kept_cents = C.ENDOWMENT * 100 - effort_cents
 
         return dict(
             total_points_so_far=total_points_so_far(player),
             is_autarkic=is_autarkic,
-            effort_to_firm_disp=f"{effort_to_firm:.2f}",
-            effort_kept_disp=f"{effort_kept:.2f}",
-            endowment_disp=f"{float(C.ENDOWMENT):.2f}",
+            effort_to_firm_disp=payoffs.cents_str(effort_cents),
+            effort_kept_disp=payoffs.cents_str(effort_kept_cents),
+            endowment_disp=payoffs.cents_str(C.ENDOWMENT * 100),
         )
 
 
@@ -731,6 +1580,8 @@ class Results(Page):
             firm_size=len(player.group.get_players()),
             members=[p.id_in_subsession for p in player.group.get_players()],
             total_points_so_far=total_points_so_far(player),
+            total_effort_disp=payoffs.cents_str(player.group.total_effort_cents),
+            effort_to_firm_disp=payoffs.cents_str(player.effort_cents),
         )
 
 
@@ -792,6 +1643,20 @@ class FinalSummary(Page):
             total_payment=f"{total_payment:.2f}",
         )
 
+def custom_export(players):
+   # exact integer (hundredths of a point) efforts and payoffs per player-round
+   yield ['session_code', 'participant_code', 'round_number', 'id_in_subsession',
+          'firm_owner_id', 'firm_size', 'effort_cents', 'payoff_cents',
+          'total_effort_cents', 'per_capita_payout_cents', 'treatment']
+   for p in players:
+       g = p.group
+       yield [p.session.code, p.participant.code, p.round_number, p.id_in_subsession,
+              p.firm_owner_id, g.firm_size, p.effort_cents, p.payoff_cents,
+              g.total_effort_cents, g.per_capita_payout_cents, p.session.config['name']]
+
+
+
+
 page_sequence = [
    Tutorial,
    Formation,
@@ -805,4 +1670,4 @@ page_sequence = [
 ]
 
 
-
+profiling.instrument(page_sequence)
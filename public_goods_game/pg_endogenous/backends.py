@@ -0,0 +1,497 @@
+"""
+Formation state / event backends for live_formation (T3/T4).
+
+A formation market is one (session code, round number). Every accepted
+action bumps the board revision `rev` (see _bump_versions), so the revisions
+of a market form a single ordered event stream; clients drop payloads older
+than what they already show, and pings carry the revision they have.
+
+InProcessBackend (default): oTree runs live methods one at a time in its one
+server process and the formation state lives in Subsession.formation_state,
+so there is nothing to share. The backend only keeps the recent events of
+each market.
+
+ManagerBackend: for several server workers in front of one database. The
+state of each market, a lock per market and the event stream live in a
+small separate process (a multiprocessing manager on a local socket), so
+whichever worker receives a message works on the latest state, actions on
+one market are applied one at a time in revision order, and clients attached
+to other workers are told about the change by that worker's relay thread
+(see relay.py). The database field
+is still written on every change (exports, restarts). Start it with:
+
+    python pg_endogenous/backends.py serve 127.0.0.1:50123
+
+and point every worker at it:
+
+    PGG_FORMATION_BACKEND=manager://127.0.0.1:50123 otree prodserver1of2
+
+PGG_FORMATION_BACKEND_KEY sets the shared authkey (same value on both sides).
+
+PostgresBackend (PGG_FORMATION_BACKEND=postgres, DATABASE_URL must point at
+PostgreSQL): the board is kept as rows in dedicated tables instead of one
+JSON blob. An application or acceptance is one row, and unique constraints
+back the rules (one application per owner/applicant pair, at most one
+employer per player). Every change is written by one data-modifying
+statement. The board is read with one indexed query. Writers to a market
+are serialized by a transaction-level advisory lock. The connection pool
+size is set with PGG_FORMATION_POOL_SIZE. SQLite (devserver) keeps using
+the default backend.
+
+This module does not import oTree, so the manager process needs nothing but
+the standard library.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from collections import deque
+from contextlib import contextmanager, nullcontext
+from multiprocessing.managers import AcquirerProxy, BaseManager
+
+
+# recent events kept per market (admin monitoring / debugging)
+HISTORY = 500
+# a worker that died holding a market lock must not wedge the market
+LOCK_TIMEOUT_SECONDS = 10
+
+
+class InProcessBackend:
+    shared = False
+
+    def __init__(self):
+        self._events = {}
+        self._guard = threading.Lock()
+
+    def lock(self, market):
+        return nullcontext()
+
+    def load(self, market):
+        """Serialized state of the market, or None to use the database field."""
+        return None
+
+    def store(self, market, raw_state):
+        pass
+
+    def publish(self, market, event):
+        """Append an event (a dict with the new 'rev') to the market's stream."""
+        event = dict(event, t=time.time())
+        with self._guard:
+            events = self._events.get(market)
+            if events is None:
+                events = self._events[market] = deque(maxlen=HISTORY)
+            events.append(event)
+
+    def events_since(self, market, rev):
+        with self._guard:
+            return [e for e in self._events.get(market, ()) if e['rev'] > rev]
+
+    def latest_round(self, session_code):
+        """Newest round of the session with a stored market, or None (in-process: the caller's caches)."""
+        return None
+
+    def drop_before(self, session_code, round_number):
+        with self._guard:
+            for key in [k for k in self._events if k[0] == session_code and k[1] < round_number]:
+                del self._events[key]
+
+
+class _SharedStore(InProcessBackend):
+    # lives in the manager process; every worker talks to this one instance
+
+    def __init__(self):
+        super().__init__()
+        self._states = {}
+        self._locks = {}
+
+    def lock_for(self, market):
+        with self._guard:
+            lock = self._locks.get(market)
+            if lock is None:
+                lock = self._locks[market] = threading.Lock()
+            return lock
+
+    def load(self, market):
+        return self._states.get(market)
+
+    def store(self, market, raw_state):
+        with self._guard:
+            self._states[market] = raw_state
+
+    def latest_round(self, session_code):
+        with self._guard:
+            rounds = [k[1] for k in self._states if k[0] == session_code]
+        return max(rounds) if rounds else None
+
+    def drop_before(self, session_code, round_number):
+        super().drop_before(session_code, round_number)
+        with self._guard:
+            for table in (self._states, self._locks):
+                for key in [k for k in table if k[0] == session_code and k[1] < round_number]:
+                    del table[key]
+
+
+_STORE = None
+
+
+def _get_store():
+    global _STORE
+    if _STORE is None:
+        _STORE = _SharedStore()
+    return _STORE
+
+
+class _BackendManager(BaseManager):
+    pass
+
+
+_BackendManager.register('store', callable=_get_store, method_to_typeid={'lock_for': 'Lock'})
+_BackendManager.register('Lock', proxytype=AcquirerProxy, create_method=False)
+
+
+class ManagerBackend:
+    shared = True
+
+    def __init__(self, address, authkey):
+        manager = _BackendManager(address=address, authkey=authkey)
+        manager.connect()
+        self._store = manager.store()
+        self._locks = {}
+
+    @contextmanager
+    def lock(self, market):
+        lock = self._locks.get(market)
+        if lock is None:
+            lock = self._locks[market] = self._store.lock_for(market)
+        if not lock.acquire(timeout=LOCK_TIMEOUT_SECONDS):
+            raise Exception(f"Formation market {market} is locked by another worker")
+        try:
+            yield
+        finally:
+            lock.release()
+
+    def load(self, market):
+        return self._store.load(market)
+
+    def store(self, market, raw_state):
+        self._store.store(market, raw_state)
+
+    def publish(self, market, event):
+        self._store.publish(market, event)
+
+    def events_since(self, market, rev):
+        return self._store.events_since(market, rev)
+
+    def latest_round(self, session_code):
+        return self._store.latest_round(session_code)
+
+    def drop_before(self, session_code, round_number):
+        for key in [k for k in self._locks if k[0] == session_code and k[1] < round_number]:
+            del self._locks[key]
+        self._store.drop_before(session_code, round_number)
+
+
+# ---------------------------
+# PostgreSQL
+# ---------------------------
+_PG_SCHEMA = """
+CREATE TABLE IF NOT EXISTS pgg_formation_market (
+    session_code varchar(16) NOT NULL,
+    round_number integer NOT NULL,
+    n_players integer NOT NULL,
+    rev integer NOT NULL,
+    meta jsonb NOT NULL,
+    PRIMARY KEY (session_code, round_number)
+);
+CREATE TABLE IF NOT EXISTS pgg_formation_application (
+    id bigserial PRIMARY KEY,
+    session_code varchar(16) NOT NULL,
+    round_number integer NOT NULL,
+    owner integer NOT NULL,
+    applicant integer NOT NULL,
+    UNIQUE (session_code, round_number, owner, applicant)
+);
+CREATE TABLE IF NOT EXISTS pgg_formation_employment (
+    id bigserial PRIMARY KEY,
+    session_code varchar(16) NOT NULL,
+    round_number integer NOT NULL,
+    owner integer NOT NULL,
+    employee integer NOT NULL,
+    UNIQUE (session_code, round_number, employee)
+);
+CREATE TABLE IF NOT EXISTS pgg_formation_rejection (
+    id bigserial PRIMARY KEY,
+    session_code varchar(16) NOT NULL,
+    round_number integer NOT NULL,
+    owner integer NOT NULL,
+    applicant integer NOT NULL,
+    reason varchar(32) NOT NULL
+);
+CREATE INDEX IF NOT EXISTS pgg_formation_rejection_market
+    ON pgg_formation_rejection (session_code, round_number);
+CREATE TABLE IF NOT EXISTS pgg_formation_event (
+    session_code varchar(16) NOT NULL,
+    round_number integer NOT NULL,
+    rev integer NOT NULL,
+    type varchar(16) NOT NULL,
+    player integer NOT NULL,
+    created double precision NOT NULL,
+    PRIMARY KEY (session_code, round_number, rev)
+);
+"""
+
+# the whole board of one market; every branch uses its table's market index.
+# First column: 0 market row, 1 application, 2 employment, 3 rejection.
+_PG_READ = """
+SELECT 0, n_players, rev, meta::text, 0::bigint FROM pgg_formation_market
+    WHERE session_code = %(session)s AND round_number = %(round)s
+UNION ALL
+SELECT 1, owner, applicant, NULL, id FROM pgg_formation_application
+    WHERE session_code = %(session)s AND round_number = %(round)s
+UNION ALL
+SELECT 2, owner, employee, NULL, id FROM pgg_formation_employment
+    WHERE session_code = %(session)s AND round_number = %(round)s
+UNION ALL
+SELECT 3, owner, applicant, reason, id FROM pgg_formation_rejection
+    WHERE session_code = %(session)s AND round_number = %(round)s
+ORDER BY 1, 5
+"""
+
+# one statement: all sub-statements commit or fail together
+_PG_WRITE = """
+WITH del_app AS (
+    DELETE FROM pgg_formation_application t
+    USING unnest(%(del_app_owner)s::int[], %(del_app_person)s::int[]) AS d(owner, person)
+    WHERE t.session_code = %(session)s AND t.round_number = %(round)s
+      AND t.owner = d.owner AND t.applicant = d.person
+), del_emp AS (
+    DELETE FROM pgg_formation_employment t
+    USING unnest(%(del_emp_owner)s::int[], %(del_emp_person)s::int[]) AS d(owner, person)
+    WHERE t.session_code = %(session)s AND t.round_number = %(round)s
+      AND t.owner = d.owner AND t.employee = d.person
+), add_app AS (
+    INSERT INTO pgg_formation_application (session_code, round_number, owner, applicant)
+    SELECT %(session)s, %(round)s, owner, person
+    FROM unnest(%(add_app_owner)s::int[], %(add_app_person)s::int[])
+        WITH ORDINALITY AS a(owner, person, i)
+    ORDER BY i
+), add_emp AS (
+    INSERT INTO pgg_formation_employment (session_code, round_number, owner, employee)
+    SELECT %(session)s, %(round)s, owner, person
+    FROM unnest(%(add_emp_owner)s::int[], %(add_emp_person)s::int[])
+        WITH ORDINALITY AS a(owner, person, i)
+    ORDER BY i
+), add_rej AS (
+    INSERT INTO pgg_formation_rejection (session_code, round_number, owner, applicant, reason)
+    SELECT %(session)s, %(round)s, owner, person, reason
+    FROM unnest(%(rej_owner)s::int[], %(rej_person)s::int[], %(rej_reason)s::text[])
+        WITH ORDINALITY AS r(owner, person, reason, i)
+    ORDER BY i
+)
+INSERT INTO pgg_formation_market (session_code, round_number, n_players, rev, meta)
+VALUES (%(session)s, %(round)s, %(n)s, %(rev)s, %(meta)s::jsonb)
+ON CONFLICT (session_code, round_number)
+DO UPDATE SET rev = EXCLUDED.rev, meta = EXCLUDED.meta
+"""
+
+_ROW_KEYS = ('pending', 'accepted', 'employer', 'rejections', 'rev')
+
+
+def _edges(state, key):
+    return [(int(owner_s), person) for owner_s, people in state[key].items() for person in people]
+
+
+def _state_from_rows(rows):
+    """Formation state dict from the rows of _PG_READ, or None if the market has none."""
+    if not rows or rows[0][0] != 0:
+        return None
+    _, n, rev, meta, _ = rows[0]
+    owners = [str(i) for i in range(1, n + 1)]
+    state = dict(
+        pending={o: [] for o in owners},
+        accepted={o: [] for o in owners},
+        employer={o: None for o in owners},
+        rejections=[],
+        rev=rev,
+    )
+    for kind, owner, person, reason, _ in rows[1:]:
+        if kind == 1:
+            state['pending'][str(owner)].append(person)
+        elif kind == 2:
+            state['accepted'][str(owner)].append(person)
+            state['employer'][str(person)] = owner
+        else:
+            state['rejections'].append(dict(applicant=person, owner=owner, reason=reason))
+    state.update(json.loads(meta))
+    return state
+
+
+def _write_params(market, old, new):
+    """Parameters of _PG_WRITE that turn the rows of `old` (or nothing) into `new`."""
+    params = dict(
+        session=market[0], round=market[1], n=len(new['employer']), rev=new.get('rev', 0),
+        meta=json.dumps({k: v for k, v in new.items() if k not in _ROW_KEYS}),
+    )
+    for key, tag in (('pending', 'app'), ('accepted', 'emp')):
+        before = _edges(old, key) if old else []
+        after = _edges(new, key)
+        removed = set(before) - set(after)
+        added = [e for e in after if e not in set(before)]
+        params[f'del_{tag}_owner'] = [o for o, _ in removed]
+        params[f'del_{tag}_person'] = [p for _, p in removed]
+        params[f'add_{tag}_owner'] = [o for o, _ in added]
+        params[f'add_{tag}_person'] = [p for _, p in added]
+    # rejections are append-only
+    new_rejections = new['rejections'][len(old['rejections']) if old else 0:]
+    params['rej_owner'] = [r['owner'] for r in new_rejections]
+    params['rej_person'] = [r['applicant'] for r in new_rejections]
+    params['rej_reason'] = [r['reason'] for r in new_rejections]
+    return params
+
+
+class PostgresBackend:
+    shared = True
+
+    def __init__(self, dsn, pool_size):
+        try:
+            from psycopg2.pool import ThreadedConnectionPool
+        except ImportError:
+            raise Exception("PGG_FORMATION_BACKEND=postgres needs psycopg2 (see requirements.txt)")
+        # live methods of one worker run one at a time, so at any moment a
+        # worker needs one connection for live_formation plus one per page
+        # request that finalizes or pre-warms a round
+        self._pool = ThreadedConnectionPool(1, pool_size, dsn)
+        self._local = threading.local()
+        with self._cursor() as cur:
+            # workers starting together must not race on CREATE TABLE
+            cur.execute("SELECT pg_advisory_xact_lock(hashtext('pgg_formation_schema'))")
+            cur.execute(_PG_SCHEMA)
+
+    @contextmanager
+    def lock(self, market):
+        conn = self._pool.getconn()
+        self._local.conn = conn
+        self._local.loaded = {}
+        try:
+            with conn:  # commit on success, roll back on error
+                with conn.cursor() as cur:
+                    cur.execute(f"SET LOCAL lock_timeout = '{LOCK_TIMEOUT_SECONDS}s'")
+                    cur.execute("SELECT pg_advisory_xact_lock(hashtext(%s), %s)", market)
+                yield
+        finally:
+            self._local.conn = None
+            self._pool.putconn(conn)
+
+    @contextmanager
+    def _cursor(self, lock_market=None):
+        # reuse the transaction of the enclosing lock() if there is one
+        conn = getattr(self._local, 'conn', None)
+        if conn is not None:
+            with conn.cursor() as cur:
+                yield cur
+        elif lock_market is not None:
+            with self.lock(lock_market):
+                with self._local.conn.cursor() as cur:
+                    yield cur
+        else:
+            conn = self._pool.getconn()
+            try:
+                with conn:
+                    with conn.cursor() as cur:
+                        yield cur
+            finally:
+                self._pool.putconn(conn)
+
+    def _read(self, cur, market):
+        cur.execute(_PG_READ, dict(session=market[0], round=market[1]))
+        return _state_from_rows(cur.fetchall())
+
+    def load(self, market):
+        with self._cursor() as cur:
+            state = self._read(cur, market)
+        if state is None:
+            return None
+        if getattr(self._local, 'conn', None) is not None:
+            self._local.loaded[market] = state
+        return json.dumps(state)
+
+    def store(self, market, raw_state):
+        state = json.loads(raw_state)
+        with self._cursor(lock_market=market) as cur:
+            old = self._local.loaded.get(market)
+            if old is None:
+                old = self._read(cur, market)
+            cur.execute(_PG_WRITE, _write_params(market, old, state))
+            self._local.loaded[market] = state
+
+    def publish(self, market, event):
+        with self._cursor(lock_market=market) as cur:
+            cur.execute(
+                "INSERT INTO pgg_formation_event (session_code, round_number, rev, type, player, created)"
+                " VALUES (%s, %s, %s, %s, %s, %s) ON CONFLICT DO NOTHING",
+                (market[0], market[1], event['rev'], event.get('type', ''), event.get('player', 0), time.time()),
+            )
+
+    def events_since(self, market, rev):
+        with self._cursor() as cur:
+            cur.execute(
+                "SELECT rev, type, player, created FROM pgg_formation_event"
+                " WHERE session_code = %s AND round_number = %s AND rev > %s ORDER BY rev",
+                (market[0], market[1], rev),
+            )
+            return [dict(rev=r, type=t, player=p, t=c) for r, t, p, c in cur.fetchall()]
+
+    def latest_round(self, session_code):
+        with self._cursor() as cur:
+            cur.execute(
+                "SELECT max(round_number) FROM pgg_formation_market WHERE session_code = %s",
+                (session_code,),
+            )
+            return cur.fetchone()[0]
+
+    def drop_before(self, session_code, round_number):
+        # the rows are the record of the session; nothing to evict
+        pass
+
+
+def _parse_address(text):
+    host, _, port = text.rpartition(':')
+    return (host or '127.0.0.1', int(port))
+
+
+def _authkey():
+    return os.environ.get('PGG_FORMATION_BACKEND_KEY', 'pgg-formation').encode()
+
+
+_BACKEND = None
+
+
+def get_backend():
+    global _BACKEND
+    if _BACKEND is None:
+        spec = os.environ.get('PGG_FORMATION_BACKEND', '') or 'inprocess'
+        if spec == 'inprocess':
+            _BACKEND = InProcessBackend()
+        elif spec.startswith('manager://'):
+            _BACKEND = ManagerBackend(_parse_address(spec[len('manager://'):]), _authkey())
+        elif spec == 'postgres':
+            dsn = os.environ.get('DATABASE_URL', '')
+            if not dsn.startswith('postgres'):
+                raise Exception("PGG_FORMATION_BACKEND=postgres needs DATABASE_URL to point at PostgreSQL")
+            _BACKEND = PostgresBackend(dsn, int(os.environ.get('PGG_FORMATION_POOL_SIZE', 4)))
+        else:
+            raise Exception(f"Unknown PGG_FORMATION_BACKEND: {spec}")
+    return _BACKEND
+
+
+def serve(address):
+    manager = _BackendManager(address=_parse_address(address), authkey=_authkey())
+    print(f"formation backend listening on {address}", flush=True)
+    manager.get_server().serve_forever()
+
+
+if __name__ == '__main__':
+    if len(sys.argv) != 3 or sys.argv[1] != 'serve':
+        sys.exit("usage: python pg_endogenous/backends.py serve HOST:PORT")
+    serve(sys.argv[2])
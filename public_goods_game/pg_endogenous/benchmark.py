@@ -0,0 +1,86 @@
+"""
+Efficiency benchmark for endogenous rounds (T3/T4).
+
+Compares the realized firm structure of a round with the surplus-maximizing
+partition of all players into firms of size <= MAX_FIRM_SIZE.
+
+Within one firm the surplus (kept effort + firm output) is linear in total
+effort under constant returns and convex under increasing returns, so the best
+a firm of size k can do is at an endpoint: everyone keeps everything
+(k * endowment) or everyone contributes everything. That gives a value v(k)
+per firm size, and the best partition of n players is an integer-partition
+problem over sizes, solved by dynamic programming over the number of players
+still to place. Results are memoized per (remaining players, returns spec), so
+sessions with the same config share the work.
+
+Values are in hundredths of a point, like Player.payoff_cents.
+"""
+from functools import lru_cache
+
+
+def returns_spec(config, mpcr_by_size, endowment, max_size):
+    """Hashable description of a session's production technology."""
+    returns_type = config['returns_type']
+    if returns_type == 'constant':
+        params = tuple(sorted(mpcr_by_size.items()))
+    elif returns_type == 'increasing':
+        params = (float(config['a']), float(config['b']))
+    else:
+        raise Exception(f"Unknown returns_type: {returns_type}")
+    return (returns_type, params, endowment, max_size)
+
+
+@lru_cache(maxsize=None)
+def firm_value_cents(size, spec):
+    """Largest total surplus a firm of `size` members can produce."""
+    returns_type, params, endowment, max_size = spec
+    kept_all = size * endowment
+    if size == 1:
+        return kept_all * 100
+    total_effort = size * endowment
+    if returns_type == 'constant':
+        output = dict(params)[size] * total_effort * size
+    else:
+        a, b = params
+        output = a * total_effort ** b
+    return round(100 * max(kept_all, output))
+
+
+@lru_cache(maxsize=None)
+def _best(remaining, spec):
+    # (value, sizes) of the best partition of `remaining` players
+    if remaining == 0:
+        return 0, ()
+    max_size = spec[3]
+    best = None
+    for size in range(1, min(max_size, remaining) + 1):
+        value, sizes = _best(remaining - size, spec)
+        value += firm_value_cents(size, spec)
+        if best is None or value > best[0]:
+            best = (value, (size,) + sizes)
+    return best
+
+
+def optimal_partition(n_players, spec):
+    """(surplus in cents, firm sizes largest first) of the best partition."""
+    # fill the table bottom-up so deep sessions never hit the recursion limit
+    for m in range(n_players + 1):
+        _best(m, spec)
+    value, sizes = _best(n_players, spec)
+    return value, tuple(sorted(sizes, reverse=True))
+
+
+def efficiency(firm_sizes, realized_cents, spec):
+    """
+    firm_sizes: sizes of the round's groups (1 = autarky)
+    realized_cents: sum of all players' payoff_cents in the round
+    """
+    optimum, optimal_sizes = optimal_partition(sum(firm_sizes), spec)
+    structure = sum(firm_value_cents(k, spec) for k in firm_sizes)
+    return dict(
+        optimum_cents=optimum,
+        optimal_sizes=optimal_sizes,
+        structure_cents=structure,
+        structure_efficiency=structure / optimum if optimum else 0.0,
+        realized_efficiency=realized_cents / optimum if optimum else 0.0,
+    )
@@ -0,0 +1,210 @@
+"""
+Websocket push for the experimenter monitor (the session's Reports tab).
+
+admin_report.html opens /formation_monitor/<session code>. MonitorConsumer
+sends the monitor data when the session's current formation market changes,
+at most once per MONITOR_SECONDS, and nothing while it stays the same.
+
+The current market of a session is the one its participants last sent a
+Formation message on, or that was last finalized (note(), called by
+live_formation and finalize_formation). prewarm_next_round prepares the next
+round without noting it, so between rounds the monitor keeps showing the
+market that just ended.
+
+Where changes come from:
+- In-process backend: every change runs in this process, so note() carries
+  the state itself and the monitor reads nothing else but the backend's
+  in-memory event list. No queries at all.
+- Shared backends (manager / postgres): changes applied by other workers
+  arrive as the relay's notices (relay.listen), the same ones participants
+  get. The monitor then reads the market from the backend (one load plus one
+  events_since, off the event loop), at most once per MONITOR_SECONDS per
+  open tab; with postgres those are queries on the backend's tables. On
+  connect it asks the backend once for the session's newest market
+  (latest_round) and it also listens to the round after it, to follow the
+  session into the next round.
+
+The consumer uses oTree internals: the private base class
+_OTreeAsyncJsonWebsocketConsumer (login check, connect/disconnect hooks) and
+otree.channels.routing.websocket_routes, which oTree adds to its routes after
+importing the apps. Both were checked against oTree 6.0.15. If they are gone
+in another version, register() logs a warning and the Reports tab says the
+monitor is unavailable; the experiment itself is not affected.
+"""
+import asyncio
+import json
+import logging
+import threading
+
+from . import backends
+from . import relay
+
+
+logger = logging.getLogger(__name__)
+
+MONITOR_SECONDS = 1
+ROUTE = '/formation_monitor/{code}'
+
+_guard = threading.Lock()
+# session code -> (round number, serialized state) of its current market
+_current = {}
+# session code -> {consumer: wake-up callback}
+_consumers = {}
+# set by register(): build(round_number, state, events) -> the data sent to the page
+_build = None
+
+
+def note(market, raw_state):
+    """The session's participants are on `market`, which holds `raw_state` (any thread)."""
+    session_code, round_number = market
+    with _guard:
+        current = _current.get(session_code)
+        if current is not None and (current[0] > round_number or current == (round_number, raw_state)):
+            return
+        _current[session_code] = (round_number, raw_state)
+        wakes = list(_consumers.get(session_code, {}).values())
+    for wake in wakes:
+        wake(round_number)
+
+
+def current(session_code):
+    with _guard:
+        return _current.get(session_code)
+
+
+def available():
+    return _build is not None
+
+
+def register(build):
+    """Add the websocket route; `build` renders the monitor data. Returns False if oTree lacks the internals."""
+    global _build
+    try:
+        from otree.channels.consumers import _OTreeAsyncJsonWebsocketConsumer
+        from otree.channels.routing import websocket_routes
+        from starlette.routing import WebSocketRoute
+    except ImportError:
+        logger.warning("formation monitor: this oTree version lacks the websocket internals it uses (see monitor.py)")
+        return False
+
+    class MonitorConsumer(_OTreeAsyncJsonWebsocketConsumer):
+        # oTree sets _requires_login on every websocket route from AUTH_LEVEL, as
+        # for its admin pages (this one needs a login in DEMO mode as well)
+
+        def group_name(self, code):
+            return None
+
+        async def post_connect(self, code):
+            self._pusher = asyncio.create_task(_push(self, code))
+
+        async def pre_disconnect(self, code):
+            pusher = getattr(self, '_pusher', None)
+            if pusher:
+                pusher.cancel()
+
+    _build = build
+    # oTree appends websocket_routes to its routes after importing the apps
+    if not any(getattr(r, 'path', None) == ROUTE for r in websocket_routes):
+        websocket_routes.append(WebSocketRoute(ROUTE, MonitorConsumer))
+    return True
+
+
+async def _push(consumer, code):
+    try:
+        await _Watch(consumer, code).run()
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        # the page reconnects when the socket closes
+        logger.exception(f"formation monitor of session {code} failed")
+        await consumer.websocket.close(code=1011)
+
+
+class _Watch:
+    """One open Reports tab: wakes on changes of the session's market and sends the data."""
+
+    def __init__(self, consumer, code):
+        self.consumer = consumer
+        self.code = code
+        self.loop = asyncio.get_running_loop()
+        self.changed = asyncio.Event()
+        self.round_number = None
+        self.listening = []
+
+    def wake(self, round_number):
+        # from any thread (live methods, finalize, the relay thread)
+        self.loop.call_soon_threadsafe(self._woken, round_number)
+
+    def _woken(self, round_number):
+        if self.round_number is None or round_number > self.round_number:
+            self.round_number = round_number
+        self.changed.set()
+
+    async def run(self):
+        backend = backends.get_backend()
+        with _guard:
+            _consumers.setdefault(self.code, {})[self.consumer] = self.wake
+        try:
+            self.changed.set()
+            last = None
+            while True:
+                await self.changed.wait()
+                self.changed.clear()
+                if backend.shared:
+                    round_number, data = await self.loop.run_in_executor(None, self._read_shared, backend)
+                    if round_number is not None and (self.round_number is None
+                                                     or round_number > self.round_number):
+                        self.round_number = round_number
+                    self._listen()
+                else:
+                    data = self._read_local(backend)
+                if data != last:
+                    await self.consumer.send_json(data)
+                    last = data
+                await asyncio.sleep(MONITOR_SECONDS)
+        finally:
+            with _guard:
+                consumers = _consumers.get(self.code, {})
+                consumers.pop(self.consumer, None)
+                if not consumers:
+                    _consumers.pop(self.code, None)
+            for market in self.listening:
+                relay.unlisten(market, self)
+
+    def _read_local(self, backend):
+        # on the event loop: _current is only read under _guard, and the
+        # in-process event list is copied under the backend's own lock
+        market = current(self.code)
+        if market is None:
+            return dict(open=False)
+        round_number, raw = market
+        return _build(round_number, json.loads(raw), backend.events_since((self.code, round_number), 0))
+
+    def _read_shared(self, backend):
+        """(round number, data); in an executor thread, backend reads only."""
+        round_number = self.round_number
+        local = current(self.code)
+        if local is not None and (round_number is None or local[0] > round_number):
+            round_number = local[0]
+        if round_number is None:
+            round_number = backend.latest_round(self.code)
+        if round_number is None:
+            return None, dict(open=False)
+        raw = backend.load((self.code, round_number))
+        if raw is None:
+            return round_number, dict(open=False)
+        events = backend.events_since((self.code, round_number), 0)
+        return round_number, _build(round_number, json.loads(raw), events)
+
+    def _listen(self):
+        # on the event loop: relay notices for the shown market and the next one
+        # (round 1 until the session has a market)
+        round_number = self.round_number or 1
+        wanted = [(self.code, round_number), (self.code, round_number + 1)]
+        for market in self.listening:
+            if market not in wanted:
+                relay.unlisten(market, self)
+        for market in wanted:
+            if market not in self.listening:
+                relay.listen(market, self, lambda market, rev: self.wake(market[1]))
+        self.listening = wanted
@@ -0,0 +1,128 @@
+"""
+Cross-worker push for the shared formation backends (manager / postgres).
+
+oTree's live channel is per process: what a live method returns reaches only
+the participants whose websocket is attached to the worker that ran it. So
+each worker runs one relay thread that follows the backend's event stream of
+the markets its own participants are on. When a change was applied by another
+worker, it sends those participants a small {'rev': N} notice; the page
+answers with a ping and gets the new board from its own worker (one backend
+read). A change thus reaches every worker within about POLL_SECONDS plus a
+round trip, not at the next 1.5 s ping.
+
+The experimenter monitor (monitor.py) subscribes to the same notices with
+listen(): its callback is called from the relay thread with the market and
+the new revision.
+
+With the in-process backend there is one worker and nothing to relay.
+"""
+import asyncio
+import logging
+import threading
+import time
+
+from otree.channels import utils as channel_utils
+
+from . import backends
+
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 0.1
+# pages ping every 1.5 s; a participant silent for this long has left Formation
+STALE_SECONDS = 5
+
+_guard = threading.Lock()
+# market -> dict(rev=highest revision this worker has sent,
+#                targets={channel group: last seen}, listeners={key: callback})
+_markets = {}
+_loop = None
+_thread = None
+
+
+def _start():
+    # with _guard held; False when not under the server (bots call live methods directly)
+    global _loop, _thread
+    if _thread is None:
+        try:
+            _loop = asyncio.get_running_loop()
+        except RuntimeError:
+            return False
+        _thread = threading.Thread(target=_run, name='formation-relay', daemon=True)
+        _thread.start()
+    return True
+
+
+def _market(market, rev):
+    m = _markets.get(market)
+    if m is None:
+        m = _markets[market] = dict(rev=rev, targets={}, listeners={})
+    m['rev'] = max(m['rev'], rev)
+    return m
+
+
+def watch(market, session_code, page_index, participant_code, rev):
+    """Called by live_formation: this worker serves the participant on `market` up to `rev`."""
+    with _guard:
+        if not _start():
+            return
+        group = channel_utils.live_group(session_code, page_index, participant_code)
+        _market(market, rev)['targets'][group] = time.monotonic()
+
+
+def listen(market, key, callback):
+    """Call callback(market, rev) when another worker moves `market` on, until unlisten()."""
+    with _guard:
+        if _start():
+            _market(market, 0)['listeners'][key] = callback
+
+
+def unlisten(market, key):
+    with _guard:
+        m = _markets.get(market)
+        if m is not None:
+            m['listeners'].pop(key, None)
+
+
+def _watched():
+    now = time.monotonic()
+    out = []
+    with _guard:
+        for market in list(_markets):
+            m = _markets[market]
+            for group in [g for g, seen in m['targets'].items() if now - seen > STALE_SECONDS]:
+                del m['targets'][group]
+            if not m['targets'] and not m['listeners']:
+                del _markets[market]
+            else:
+                out.append((market, m['rev'], list(m['targets']), list(m['listeners'].values())))
+    return out
+
+
+def _run():
+    while True:
+        time.sleep(POLL_SECONDS)
+        backend = backends.get_backend()
+        for market, rev, groups, listeners in _watched():
+            try:
+                events = backend.events_since(market, rev)
+            except Exception:
+                logger.exception(f"formation relay: cannot read the events of {market}")
+                continue
+            if not events:
+                continue
+            new_rev = max(e['rev'] for e in events)
+            with _guard:
+                m = _markets.get(market)
+                if m is None or m['rev'] >= new_rev:
+                    continue  # sent by this worker in the meantime
+                m['rev'] = new_rev
+            data = dict(otree_success=True, live_method_payload=dict(rev=new_rev))
+            for group in groups:
+                asyncio.run_coroutine_threadsafe(
+                    channel_utils.group_send(group=group, data=data), _loop)
+            for callback in listeners:
+                try:
+                    callback(market, new_rev)
+                except Exception:
+                    logger.exception(f"formation relay: a listener of {market} failed")
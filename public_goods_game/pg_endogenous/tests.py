@@ -1,14 +1,53 @@
-from otree.api import Bot, Submission
+from otree.api import Bot, Submission, expect
+import asyncio
 import random
-from . import C, Formation, FirmAssignment, Decision, Results, Relay
+import time
+from . import (
+    C, Tutorial, Formation, FirmAssignment, Decision, Results, Relay,
+    _board, _get_state, _snapshot_seconds, board_at,
+    firm_roster, rounds_together, rounds_with_owner,
+)
 
 
 class PlayerBot(Bot):
     def play_round(self):
+        if self.round_number == 1:
+            yield Tutorial
 
         # Formation is a live page with no submit button, so disable HTML check.
+        # With bot_live_intensity > 0, call_live_method below has already run
+        # the hiring market for this round by the time the page is submitted.
         yield Submission(Formation, timeout_happened=True, check_html=False)
 
+        # the regrouping must match the finalized formation state
+        # (before_next_page finalizes in test_mode)
+        state = _get_state(self.subsession)
+        member_ids = sorted(p.id_in_subsession for p in self.player.group.get_players())
+        if self.player.is_autarkic:
+            expect(member_ids, [self.player.id_in_subsession])
+        else:
+            owner = self.player.firm_owner_id
+            expect(member_ids, sorted([owner] + state['accepted'][str(owner)]))
+
+        # the membership index agrees with the rosters (autarky has no rows)
+        code, me, r = self.session.code, self.player.id_in_subsession, self.round_number
+        if self.player.is_autarkic:
+            expect(r in rounds_together(code, me, me), False)
+        else:
+            owner = self.player.firm_owner_id
+            expect(firm_roster(code, owner)[r], member_ids)
+            expect(r in rounds_with_owner(code, me, owner), True)
+            for p in self.subsession.get_players():
+                other = p.id_in_subsession
+                expect(r in rounds_together(code, me, other), other in member_ids)
+
+        # this player got their own deadline when Formation was first shown
+        expect(self.player.formation_deadline, '>', 0)
+
+        # the recorded board ends on the closed market
+        if _snapshot_seconds(self.subsession):
+            expect(board_at(self.session.code, self.round_number, 10 ** 6)[1], _board(state))
+
         # FirmAssignment needs a Next button in its HTML (see note below).
         yield FirmAssignment
 
@@ -20,3 +59,132 @@ class PlayerBot(Bot):
 
         # Relay usually has no Next button (timeout page), so disable HTML check.
         yield Submission(Relay, timeout_happened=True, check_html=False)
+
+
+# ---------------------------
+# Live formation stress
+# ---------------------------
+# Session config keys:
+#   bot_live_intensity  actions per player per round (0 = leave Formation idle)
+#   bot_live_budget_ms  max allowed p95 / 4x max latency of one live call; only
+#                       for a dedicated perf config (T3_bots_perf) on an idle
+#                       machine. Without it the timings are printed, not checked.
+
+
+def call_live_method(method, group, round_number, **kwargs):
+    subsession = group.subsession
+    config = subsession.session.config
+    intensity = config.get('bot_live_intensity', 0)
+
+    # The hook runs once per (group, page). In test_mode the first bot to
+    # submit Formation finalizes and regroups, so later bots arrive with new
+    # firm groups and the hook fires again: only act on the open market.
+    if not intensity or subsession.formation_finalized:
+        return
+
+    rng = random.Random(f"{subsession.session.code}-{round_number}")
+    ids = [p.id_in_group for p in group.get_players()]
+    budget_ms = config.get('bot_live_budget_ms')
+    timings = []
+    rev = _get_state(subsession).get('rev', 0)
+
+    for _ in range(intensity * len(ids)):
+        pid = rng.choice(ids)
+        state = _get_state(subsession)
+        action, legal = _pick_action(rng, state, pid, len(ids))
+
+        t0 = time.perf_counter()
+        response = _drain(method(pid, action))
+        timings.append((time.perf_counter() - t0) * 1000)
+
+        state = _get_state(subsession)
+        _check_invariants(state, len(ids))
+        # the server must agree with the rules exactly: success is broadcast
+        # (key 0) and moves the board revision forward, a refusal does not
+        expect(0 in response, legal)
+        if legal:
+            expect(state['rev'], '>', rev)
+        else:
+            expect('alert' in response[pid], True)
+            expect(state['rev'], rev)
+        rev = state['rev']
+
+    timings.sort()
+    p50 = timings[len(timings) // 2]
+    p95 = timings[int(0.95 * (len(timings) - 1))]
+    print(f"live_formation round {round_number}: {len(timings)} calls, "
+          f"p50 {p50:.1f} ms, p95 {p95:.1f} ms, max {timings[-1]:.1f} ms")
+    if budget_ms:
+        expect(p95, '<', budget_ms)
+        expect(timings[-1], '<', 4 * budget_ms)
+
+
+def _drain(result):
+    # oTree 6 hands back an async generator, oTree 5 the return value itself
+    if not hasattr(result, '__aiter__'):
+        return result
+
+    async def collect():
+        return [item async for item in result]
+
+    items = asyncio.run(collect())
+    return items[-1] if items else None
+
+
+def _pick_action(rng, state, pid: int, n: int):
+    """
+    A random action for player `pid`, plus whether the rules allow it.
+    Mostly legal moves, with the occasional invalid one to exercise deny()
+    and the occasional unusable msg_id.
+    """
+    me = str(pid)
+    employer, pending, accepted = state['employer'], state['pending'], state['accepted']
+
+    if rng.random() < 0.05:
+        return dict(type='apply', owner=pid), False
+    if rng.random() < 0.02:
+        return dict(type='withdraw', owner=pid, msg_id=rng.choice([['x'], {'id': 1}, 1.5, True])), False
+
+    moves = []
+    if employer[me] is None:
+        for applicant in pending[me]:
+            full = 1 + len(accepted[me]) >= C.MAX_FIRM_SIZE
+            can_join = employer[str(applicant)] is None and not accepted[str(applicant)]
+            moves.append((3, dict(type='accept', owner=pid, applicant=applicant), can_join and not full))
+            moves.append((2, dict(type='reject', owner=pid, applicant=applicant), True))
+    if employer[me] is None and not accepted[me]:
+        for owner in range(1, n + 1):
+            o = str(owner)
+            if pid in pending[o]:
+                moves.append((1, dict(type='withdraw', owner=owner), True))
+            elif (owner != pid and employer[o] is None
+                  and 1 + len(accepted[o]) < C.MAX_FIRM_SIZE):
+                moves.append((2, dict(type='apply', owner=owner), True))
+
+    if not moves:
+        # employed or locked in: anything but a ping is refused
+        return dict(type='apply', owner=rng.randint(1, n)), False
+    weights = [w for w, _, _ in moves]
+    _, action, legal = rng.choices(moves, weights=weights)[0]
+    return action, legal
+
+
+def _check_invariants(state, n: int):
+    employer, pending, accepted = state['employer'], state['pending'], state['accepted']
+    employed = [w for ws in accepted.values() for w in ws]
+    expect(len(employed), len(set(employed)))
+
+    for owner in range(1, n + 1):
+        o = str(owner)
+        expect(1 + len(accepted[o]), '<=', C.MAX_FIRM_SIZE)
+        for w in accepted[o]:
+            expect(employer[str(w)], owner)
+        if accepted[o]:
+            # owners who hired are bound to their own firm
+            expect(employer[o], None)
+        if employer[o] is not None:
+            # inactive firms take no applications
+            expect(pending[o], [])
+            expect(owner in accepted[str(employer[o])], True)
+        for a in pending[o]:
+            expect(a != owner and employer[str(a)] is None, True)
@@ -4,9 +4,15 @@ from operator import truediv
 
 
 from otree.api import *
-import random
+import json
 import math
 
+import analytics
+import payoffs
+import profiling
+
+from . import schedule
+
 
 
 
@@ -36,65 +42,32 @@ class C(BaseConstants):
    INFO_SECONDS = 30
 
 
-   # Exogenous block structure
-   BLOCK_LENGTH = 10  # Number of rounds before reshuffle (30 rounds total)
-   EXO_SIZES = [2, 3, 4, 5, 6]  # Sums to 20
-
-
-
-
-def current_block_start(round_number: int) -> int:
-   if round_number <= 10:
-       return 1
-   elif round_number <= 20:
-       return 11
-   else:
-       return 21
-
-
-
+   # Exogenous block structure (defaults; session config keys exo_sizes,
+   # exo_num_blocks and exo_schedule_workers override them, see schedule.py)
+   NUM_BLOCKS = 3  # reshuffles: 30 rounds = 3 blocks of 10
+   EXO_SIZES = [2, 3, 4, 5, 6]  # one cohort = 20 participants
 
-# Helper function to build valid groups
-def build_exogenous_matrix(players, sizes, current_round, max_tries=5000):
-   sizes_order = sorted(sizes, reverse=True)
 
 
-   for _ in range(max_tries):
-       remaining = players.copy()
-       random.shuffle(remaining)
-       chosen_groups = []
-       ok = True
 
+def block_index(session, round_number: int) -> int:
+   # 0-based block number; indexes participant.exo_size_by_block / exo_firm_by_block
+   return schedule.block_of(round_number, session.vars['exo_schedule']['block_length'])
 
-       for size in sizes_order:
-           eligible = []
-           for p in remaining:
-               size_by_block = p.participant.vars.get('size_by_block', {})
-               # only sizes from earlier blocks (keys < current_round)
-               past_sizes = [v for k, v in size_by_block.items()
-                             if k < current_round]
-               if size not in past_sizes:
-                   eligible.append(p)
 
 
-           if len(eligible) < size:
-               ok = False
-               break
 
-
-           members = random.sample(eligible, size)
-           chosen_groups.append((size, members))
-           for p in members:
-               remaining.remove(p)
-
-
-       if ok and not remaining:
-           size_to_members = {s: m for s, m in chosen_groups}
-           return [size_to_members[s] for s in sizes]
-
-
-   raise Exception(
-       "Could not find a valid grouping without repeated firm sizes.")
+def build_schedule(session, num_players: int):
+   config = session.config
+   num_blocks = config.get('exo_num_blocks', C.NUM_BLOCKS)
+   block_length = schedule.block_length_for(C.NUM_ROUNDS, num_blocks)
+   if config.get('test_mode', False):
+       # simple grouping for testing: pairs, last group may be smaller
+       return schedule.build_pairs(num_players, num_blocks, block_length, seed=session.code)
+   return schedule.build(
+       num_players, config.get('exo_sizes', C.EXO_SIZES), num_blocks, block_length,
+       seed=session.code, workers=config.get('exo_schedule_workers', 1),
+   )
 
 
 
@@ -106,71 +79,79 @@ class Subsession(BaseSubsession):
 
 
 def creating_session(subsession: Subsession):
-   players = subsession.get_players()
-   test_mode = subsession.session.config.get('test_mode', False)
-
-
-   if subsession.round_number in [1, 11, 21]:
-
-
-       if (not test_mode) and len(players) != sum(C.EXO_SIZES):
-           raise Exception(
-               f'T1 requires exactly 20 participants; currently {len(players)}'
-           )
-
-
-       if test_mode:
-           # simple grouping for testing: groups of 2, last group may be smaller
-           random.shuffle(players)
-           matrix = []
-           i = 0
-           while i < len(players):
-               matrix.append(players[i:i + 2])
-               i += 2
-           subsession.set_group_matrix(matrix)
-       else:
-           matrix = build_exogenous_matrix(
-               players, C.EXO_SIZES, subsession.round_number)
-           subsession.set_group_matrix(matrix)
-
-
-           # record each participant's size assignment for this block start
-           for p in subsession.get_players():
-               current_size = len(p.group.get_players())
-               size_by_block = dict(
-                   p.participant.vars.get('size_by_block', {}))
-               size_by_block[subsession.round_number] = current_size
-               p.participant.vars['size_by_block'] = size_by_block
-
-
-       # Assign stable Firm IDs for this 10-round block (Firm 1..Firm K)
-       block_start = subsession.round_number
+   session = subsession.session
+
+   if subsession.round_number == 1:
+       # the whole session's firms, block by block (see schedule.py)
+       players = subsession.get_players()
+       table = build_schedule(session, len(players))
+       session.vars['exo_schedule'] = table
+
+       # fixed-shape per-block records (index = block_index, 0 = not assigned);
+       # sizes are not tracked in test_mode
+       by_id = {p.id_in_subsession: p.participant for p in players}
+       test_mode = session.config.get('test_mode', False)
+       for participant in by_id.values():
+           participant.exo_size_by_block = [0] * table['num_blocks']
+           participant.exo_firm_by_block = [0] * table['num_blocks']
+       for block, firms in enumerate(table['blocks']):
+           for firm in firms:
+               for pid in firm['members']:
+                   by_id[pid].exo_firm_by_block[block] = firm['label']
+                   if not test_mode:
+                       by_id[pid].exo_size_by_block[block] = firm['size']
+
+   # every round of a block has the block's firms, with stable "Firm k"
+   # labels per cohort
+   firms = session.vars['exo_schedule']['blocks'][block_index(session, subsession.round_number)]
+   _set_firms(subsession, firms)
+
+
+
+
+def _set_firms(subsession: Subsession, firms):
+   # Bulk version of set_group_matrix for a new round, which oTree creates
+   # with a single group. set_group_matrix commits once per group, and each
+   # commit expires every loaded object: creating a 200-participant session
+   # took over a minute, almost all of it here. Same result: groups
+   # 1..len(firms) in table order, id_in_group in member order (no roles).
+   groups = subsession.get_groups()
+   if len(groups) > len(firms):
+       subsession.set_group_matrix([firm['members'] for firm in firms])
        groups = subsession.get_groups()
-       for firm_label, g in enumerate(groups, start=1):
-           for p in g.get_players():
-               firm_by_block = dict(
-                   p.participant.vars.get('firm_by_block', {}))
-               firm_by_block[block_start] = firm_label
-               p.participant.vars['firm_by_block'] = firm_by_block
-
-
-   else:
-       if subsession.round_number <= 10:
-           subsession.group_like_round(1)
-       elif subsession.round_number <= 20:
-           subsession.group_like_round(11)
-       else:
-           subsession.group_like_round(21)
+   players = subsession.get_players()
+   for i in range(len(groups) + 1, len(firms) + 1):
+       groups.append(Group.objects_create(
+           session=subsession.session,
+           subsession=subsession,
+           round_number=subsession.round_number,
+           id_in_subsession=i,
+       ))
+   for g, firm in zip(groups, firms):
+       g.firm_label = firm['label']
+       g.cohort = firm['cohort']
+       for id_in_group, pid in enumerate(firm['members'], start=1):
+           p = players[pid - 1]
+           p.group = g
+           p.id_in_group = id_in_group
 
 
 
 
 class Group(BaseGroup):
+   # stable "Firm k" label for the current block (same for all rounds of a block)
+   firm_label = models.IntegerField(initial=0)
+   # firms only meet (Relay) within their cohort of sum(EXO_SIZES) participants
+   cohort = models.IntegerField(initial=1)
    total_effort = models.FloatField(initial=0)
    firm_size = models.IntegerField(initial=0)
    per_capita_effort = models.FloatField(initial=0)
    per_capita_payout = models.FloatField(initial=0)
 
+   # exact integer versions, in hundredths of a point
+   total_effort_cents = models.IntegerField(initial=0)
+   per_capita_payout_cents = models.IntegerField(initial=0)
+
 
 
 
@@ -182,15 +163,22 @@ class Player(BasePlayer):
    )
    payoff_points = models.FloatField(initial=0)
 
+   # exact integer versions, in hundredths of a point (effort_cents is set
+   # from effort_to_firm when Decision is submitted)
+   effort_cents = models.IntegerField(initial=0)
+   payoff_cents = models.IntegerField(initial=0)
+
+   # Results page values, computed once in set_payoffs_all_groups (JSON)
+   results_json = models.LongStringField(initial='')
+
 
 
 
 def total_points_so_far(player: Player) -> float:
-   # sum of payoffs from completed rounds (excludes current round)
-   total = 0
-   for r in range(1, player.round_number):
-       total += player.in_round(r).payoff
-   return total
+   # sum of payoffs from completed rounds (excludes current round).
+   # participant.payoff is kept up to date by oTree whenever player.payoff is
+   # set, so this needs no per-round queries.
+   return player.participant.payoff - player.payoff
 
 
 
@@ -201,42 +189,59 @@ def set_payoffs(group: Group):
    group.firm_size = n
 
 
-   total_effort = sum(p.effort_to_firm for p in players)
-   group.total_effort = total_effort
+   # integer cents: sums are exact, payout is rounded once to the cent
+   total_effort_cents = sum(p.effort_cents for p in players)
+   payout_cents = payoffs.per_capita_payout_cents(group.session.config, C.MPCR_BY_SIZE, n, total_effort_cents)
 
 
-   group.per_capita_effort = total_effort / n if n else 0
+   group.total_effort_cents = total_effort_cents
+   group.per_capita_payout_cents = payout_cents
+   group.total_effort = total_effort_cents / 100
+   group.per_capita_effort = total_effort_cents / 100 / n if n else 0
+   group.per_capita_payout = payout_cents / 100
 
 
-   # STRICT: avoids accidental wrong treatment
-   returns_type = group.session.config['returns_type']
+   for p in players:
+       p.payoff_cents = C.ENDOWMENT * 100 - p.effort_cents + payout_cents
+       p.payoff = p.payoff_cents / 100
 
 
-   if returns_type == 'constant':
-       # prefer dict instead of list for safety
-       if n not in C.MPCR_BY_SIZE:
-           raise Exception(
-               f"No MPCR specified for firm size n={n}. Check C.MPCR_BY_SIZE.")
-       alpha = C.MPCR_BY_SIZE[n]
-       per_capita_payout = alpha * total_effort
 
 
-   elif returns_type == 'increasing':
-       a = float(group.session.config['a'])
-       b = float(group.session.config['b'])
-       output = a * (total_effort ** b) if total_effort > 0 else 0.0
-       per_capita_payout = output / n
+def results_vars(player: Player):
+   group = player.group
 
 
-   else:
-       raise Exception(f"Unknown returns_type: {returns_type}")
+   # everything in integer cents; no re-rounding of floats
+   effort_cents = player.effort_cents
+   effort_kept_cents = C.ENDOWMENT * 100 - effort_cents
+   total_firm_effort_cents = group.total_effort_cents
+   payout_cents = group.per_capita_payout_cents
+   total_payoff_cents = player.payoff_cents
+   payoff_if_zero_cents = C.ENDOWMENT * 100 + payout_cents
+   personal_cost_cents = payoff_if_zero_cents - total_payoff_cents
 
 
-   group.per_capita_payout = per_capita_payout
+   return dict(
+       effort_to_firm=effort_cents / 100,
+       effort_kept=effort_kept_cents / 100,
+       selfish_payoff=effort_kept_cents / 100,
+       total_firm_effort=total_firm_effort_cents / 100,
+       firm_size=group.firm_size,
+       per_capita_payout=payout_cents / 100,
+       total_payoff=total_payoff_cents / 100,
+       personal_cost=personal_cost_cents / 100,
 
 
-   for p in players:
-       p.payoff = (C.ENDOWMENT - p.effort_to_firm) + per_capita_payout
+       # formatted versions for templates
+       effort_to_firm_disp=payoffs.cents_str(effort_cents),
+       effort_kept_disp=payoffs.cents_str(effort_kept_cents),
+       selfish_payoff_disp=payoffs.cents_str(effort_kept_cents),
+       total_firm_effort_disp=payoffs.cents_str(total_firm_effort_cents),
+       per_capita_payout_disp=payoffs.cents_str(payout_cents),
+       total_payoff_disp=payoffs.cents_str(total_payoff_cents),
+       personal_cost_disp=payoffs.cents_str(personal_cost_cents),
+   )
 
 
 
@@ -245,14 +250,13 @@ def set_payoffs_all_groups(subsession: Subsession):
    for g in subsession.get_groups():
        set_payoffs(g)
 
+   # Results is shown right after this; compute its values once here so
+   # rendering (and every refresh) is a single field read
+   for p in subsession.get_players():
+       p.results_json = json.dumps(results_vars(p))
 
-
-
-def total_points_so_far(player: Player) -> float:
-   total = 0
-   for r in range(1, player.round_number):
-       total += player.in_round(r).payoff
-   return total
+   if subsession.round_number == C.NUM_ROUNDS:
+       analytics.record_session(subsession)
 
 
 
@@ -265,17 +269,13 @@ class ResultsWaitPage(WaitPage):
 
    @staticmethod
    def vars_for_template(player: Player):
-       effort_to_firm = float(player.effort_to_firm or 0.0)
-       effort_to_firm = round(effort_to_firm, 2)
-
-
-       effort_kept = round(C.ENDOWMENT - effort_to_firm, 2)
+       effort_kept_cents = C.ENDOWMENT * 100 - player.effort_cents
 
 
        return dict(
-           effort_kept=effort_kept,  # numeric (if you ever need it)
-           effort_to_firm_disp=f"{effort_to_firm:.2f}",
-           effort_kept_disp=f"{effort_kept:.2f}",
+           effort_kept=effort_kept_cents / 100,  # numeric (if you ever need it)
+           effort_to_firm_disp=payoffs.cents_str(player.effort_cents),
+           effort_kept_disp=payoffs.cents_str(effort_kept_cents),
            total_points_so_far=total_points_so_far(player),
        )
 
@@ -305,10 +305,18 @@ class Decision(Page):
        )
 
 
+   @staticmethod
+   def js_vars(player: Player):
+       return dict(preview=payoffs.payoff_preview(
+           player.session.config, C.MPCR_BY_SIZE, len(player.group.get_players()), C.ENDOWMENT))
+
+
    @staticmethod
    def before_next_page(player: Player, timeout_happened):
-       # Enforce 2 decimals (and avoid float artifacts like 7.999999)
-       player.effort_to_firm = round(float(player.effort_to_firm or 0.0), 2)
+       # the integer cents are the value used for payoffs; the float is
+       # snapped to them (avoids float artifacts like 7.999999)
+       player.effort_cents = payoffs.to_cents(player.effort_to_firm)
+       player.effort_to_firm = player.effort_cents / 100
 
 
    @staticmethod
@@ -317,7 +325,7 @@ class Decision(Page):
        x = values.get('effort_to_firm')
        if x is None:
            return
-       if abs(x - round(x, 2)) > 1e-9:
+       if abs(x * 100 - payoffs.to_cents(x)) > 1e-6:
            return "Please choose effort in increments of 0.01."
 
 
@@ -329,51 +337,12 @@ class Results(Page):
 
    @staticmethod
    def vars_for_template(player: Player):
-       group = player.group
-
-
-       # Always work with rounded effort to avoid float artifacts
-       effort_to_firm = round(float(player.effort_to_firm or 0.0), 2)
-       effort_kept = round(C.ENDOWMENT - effort_to_firm, 2)
-
-
-       total_firm_effort = float(group.total_effort or 0.0)
-       firm_size = group.firm_size
-       per_capita_payout = float(group.per_capita_payout or 0.0)
-
-
-       total_payoff = float(player.payoff or 0.0)
-       selfish_payoff = effort_kept
-       payoff_if_zero = C.ENDOWMENT + per_capita_payout
-       personal_cost = payoff_if_zero - total_payoff
-
-
-       # Display strings (2 decimals everywhere)
-       def fmt2(x):
-           return f"{float(x or 0.0):.2f}"
-
-
-       return dict(
-           effort_to_firm=effort_to_firm,
-           effort_kept=effort_kept,
-           selfish_payoff=selfish_payoff,
-           total_firm_effort=total_firm_effort,
-           firm_size=firm_size,
-           per_capita_payout=per_capita_payout,
-           total_payoff=total_payoff,
-           personal_cost=personal_cost,
-           total_points_so_far=total_points_so_far(player),
-
-
-           # formatted versions for templates
-           effort_to_firm_disp=fmt2(effort_to_firm),
-           effort_kept_disp=fmt2(effort_kept),
-           selfish_payoff_disp=fmt2(selfish_payoff),
-           total_firm_effort_disp=fmt2(total_firm_effort),
-           per_capita_payout_disp=fmt2(per_capita_payout),
-           total_payoff_disp=fmt2(total_payoff),
-           personal_cost_disp=fmt2(personal_cost),
-       )
+       if player.results_json:
+           values = json.loads(player.results_json)
+       else:
+           values = results_vars(player)
+       values['total_points_so_far'] = total_points_so_far(player)
+       return values
 
 
 
@@ -384,19 +353,14 @@ class Relay(Page):
 
    @staticmethod
    def vars_for_template(player: Player):
-       block_start = current_block_start(player.round_number)
-
-
-       def firm_label_for_group(g):
-           any_member = g.get_players()[0]
-           return any_member.participant.vars.get('firm_by_block', {}).get(block_start, None)
-
-
        rows = []
+       cohort = player.group.cohort
        for g in player.subsession.get_groups():
+           if g.cohort != cohort:
+               continue
            rows.append(dict(
-               firm_id=firm_label_for_group(g),
-               firm_size=len(g.get_players()),
+               firm_id=g.firm_label or None,
+               firm_size=g.firm_size,
                per_capita_effort=g.per_capita_effort,
                per_capita_payout=g.per_capita_payout,
 
@@ -413,8 +377,8 @@ class Relay(Page):
                  if r["firm_id"] is not None else 999)
 
 
-       my_firm_id = player.participant.vars.get(
-           'firm_by_block', {}).get(block_start, None)
+       my_firm_id = player.participant.exo_firm_by_block[
+           block_index(player.session, player.round_number)] or None
 
 
        return dict(
@@ -456,8 +420,22 @@ class FinalSummary(Page):
 
 
 
+def custom_export(players):
+   # exact integer (hundredths of a point) efforts and payoffs per player-round
+   yield ['session_code', 'participant_code', 'round_number', 'id_in_subsession',
+          'cohort', 'firm_label', 'firm_size', 'effort_cents', 'payoff_cents',
+          'total_effort_cents', 'per_capita_payout_cents', 'treatment']
+   for p in players:
+       g = p.group
+       yield [p.session.code, p.participant.code, p.round_number, p.id_in_subsession,
+              g.cohort, g.firm_label, g.firm_size, p.effort_cents, p.payoff_cents,
+              g.total_effort_cents, g.per_capita_payout_cents, p.session.config['name']]
+
+
+
+
 page_sequence = [Tutorial, Decision,
                 ResultsWaitPage, Results, Relay, FinalSummary]
 
 
-
+profiling.instrument(page_sequence)
@@ -0,0 +1,145 @@
+"""
+Firm schedule for exogenous sessions (T1/T2): who is in which firm in every block.
+
+Participants are split at random into cohorts of sum(sizes) players. A cohort
+is a separate economy: in every block its players are divided into one firm
+per entry of `sizes`, and no player gets the same firm size twice. Cohorts
+are independent, so they are solved separately (in a process pool if asked)
+from seeds derived from the session seed, and the result does not depend on
+how many workers were used.
+
+One block of a cohort is a bipartite matching of players to firm seats, where
+a player may only take a seat of a size they have not had. Blocks are matched
+one after another (augmenting paths, random order); a dead end restarts the
+cohort with the next random order.
+
+The whole session is one JSON-able table, built once in round 1:
+
+    dict(block_length, num_blocks, cohorts,
+         blocks=[[dict(cohort, label, size, members=[id_in_subsession, ...]), ...], ...])
+
+Firms of a block are listed cohort by cohort, labelled 1..len(sizes) within
+their cohort in the order of `sizes`.
+"""
+import random
+from concurrent.futures import ProcessPoolExecutor
+
+
+def block_length_for(num_rounds, num_blocks):
+    if num_blocks < 1 or num_rounds % num_blocks:
+        raise Exception(f"{num_rounds} rounds cannot be split into {num_blocks} equal blocks")
+    return num_rounds // num_blocks
+
+
+def block_of(round_number, block_length):
+    """0-based block of a round."""
+    return (round_number - 1) // block_length
+
+
+def check(num_players, sizes, num_blocks):
+    cohort_size = sum(sizes)
+    if not sizes or min(sizes) < 1:
+        raise Exception(f"Invalid firm sizes {sizes}")
+    if num_players % cohort_size:
+        raise Exception(
+            f"Firm sizes {sizes} need a multiple of {cohort_size} participants; "
+            f"currently {num_players}")
+    # a player holds each size at most once, so over all blocks a size cannot
+    # fill more seats than a cohort has players
+    for size in set(sizes):
+        if num_blocks * size * sizes.count(size) > cohort_size:
+            raise Exception(
+                f"Firm sizes {sizes} allow at most {cohort_size // (size * sizes.count(size))} "
+                f"blocks without a repeated size (size {size}); got {num_blocks}")
+
+
+def build(num_players, sizes, num_blocks, block_length, seed, workers=1):
+    """The session table (see module docstring)."""
+    check(num_players, sizes, num_blocks)
+    ids = list(range(1, num_players + 1))
+    random.Random(f"{seed}-cohorts").shuffle(ids)
+    cohort_size = sum(sizes)
+    tasks = [
+        (ids[i:i + cohort_size], tuple(sizes), num_blocks, f"{seed}-{i // cohort_size}")
+        for i in range(0, num_players, cohort_size)
+    ]
+    if workers > 1 and len(tasks) > 1:
+        with ProcessPoolExecutor(min(workers, len(tasks))) as pool:
+            solved = list(pool.map(_solve_task, tasks))
+    else:
+        solved = [_solve_task(t) for t in tasks]
+
+    blocks = []
+    for b in range(num_blocks):
+        firms = []
+        for cohort, cohort_blocks in enumerate(solved, start=1):
+            for label, (size, members) in enumerate(zip(sizes, cohort_blocks[b]), start=1):
+                firms.append(dict(cohort=cohort, label=label, size=size, members=members))
+        blocks.append(firms)
+    return dict(block_length=block_length, num_blocks=num_blocks, cohorts=len(solved), blocks=blocks)
+
+
+def build_pairs(num_players, num_blocks, block_length, seed):
+    """test_mode table: one cohort, random pairs each block (the last firm may be smaller)."""
+    rng = random.Random(seed)
+    blocks = []
+    for _ in range(num_blocks):
+        ids = list(range(1, num_players + 1))
+        rng.shuffle(ids)
+        blocks.append([
+            dict(cohort=1, label=k + 1, size=len(ids[i:i + 2]), members=ids[i:i + 2])
+            for k, i in enumerate(range(0, num_players, 2))
+        ])
+    return dict(block_length=block_length, num_blocks=num_blocks, cohorts=1, blocks=blocks)
+
+
+def _solve_task(task):
+    members, sizes, num_blocks, seed = task
+    return solve_cohort(members, sizes, num_blocks, random.Random(seed))
+
+
+def solve_cohort(members, sizes, num_blocks, rng, max_tries=1000):
+    """For each block, one member list per entry of `sizes`; no member repeats a size."""
+    seat_sizes = [size for size in sizes for _ in range(size)]
+    for _ in range(max_tries):
+        had = {m: set() for m in members}
+        blocks = []
+        for _ in range(num_blocks):
+            seats = _match(members, seat_sizes, had, rng)
+            if seats is None:
+                break
+            firms, start = [], 0
+            for size in sizes:
+                firms.append(sorted(seats[start:start + size]))
+                start += size
+            for size, firm in zip(sizes, firms):
+                for m in firm:
+                    had[m].add(size)
+            blocks.append(firms)
+        else:
+            return blocks
+    raise Exception(f"Could not find a valid grouping without repeated firm sizes ({sizes}).")
+
+
+def _match(members, seat_sizes, had, rng):
+    """Seat -> member with no member on a size they had, or None (Kuhn's algorithm)."""
+    order = list(members)
+    rng.shuffle(order)
+    seats = list(range(len(seat_sizes)))
+    holder = [None] * len(seat_sizes)
+
+    def place(m, tried):
+        rng.shuffle(seats)
+        for s in list(seats):
+            if s in tried or seat_sizes[s] in had[m]:
+                continue
+            tried.add(s)
+            if holder[s] is None or place(holder[s], tried):
+                holder[s] = m
+                return True
+        return False
+
+    for m in order:
+        if not place(m, set()):
+            return None
+    return holder
@@ -1,32 +1,82 @@
-import random
 from otree.api import Bot, Submission, expect
 
-from . import C, Decision, Results, Relay
+from . import C, Tutorial, Decision, Results, Relay, block_index, schedule
+
+
+def raises(fn, *args):
+    try:
+        fn(*args)
+    except Exception:
+        return True
+    return False
+
+
+def check_schedule(session, num_players):
+    # the whole table, once per session (player 1, round 1)
+    table = session.vars['exo_schedule']
+    sizes = session.config.get('exo_sizes', C.EXO_SIZES)
+    expect(table['cohorts'], num_players // sum(sizes))
+    expect(len(table['blocks']), table['num_blocks'])
+
+    had = {}  # player -> sizes held so far
+    cohort_of = {}
+    for firms in table['blocks']:
+        # every player is in exactly one firm per block
+        expect(sorted(m for f in firms for m in f['members']), list(range(1, num_players + 1)))
+        for f in firms:
+            expect(len(f['members']), f['size'])
+            for m in f['members']:
+                expect(f['size'] in had.setdefault(m, set()), False)
+                had[m].add(f['size'])
+                # cohorts are fixed for the whole session
+                expect(cohort_of.setdefault(m, f['cohort']), f['cohort'])
+
+    # the table does not depend on the number of workers
+    workers = session.config.get('exo_schedule_workers', 1)
+    rebuilt = schedule.build(num_players, sizes, table['num_blocks'], table['block_length'],
+                             seed=session.code, workers=1 if workers > 1 else 2)
+    expect(rebuilt, table)
+
+    # parameters that cannot work are refused
+    expect(raises(schedule.check, 41, [2, 3, 4, 5, 6], 3), True)    # not a multiple of 20
+    expect(raises(schedule.check, 40, [2, 3, 4, 5, 6], 4), True)    # size 6 would repeat
+    expect(raises(schedule.check, 40, [], 3), True)
+    expect(raises(schedule.check, 40, [0, 2], 3), True)
+    expect(raises(schedule.block_length_for, 30, 4), True)
+    expect(raises(schedule.check, 40, [2, 3, 4, 5, 6], 3), False)
 
 
 class PlayerBot(Bot):
     def play_round(self):
+        if self.round_number == 1:
+            if self.player.id_in_subsession == 1 and not self.session.config.get('test_mode', False):
+                check_schedule(self.session, len(self.subsession.get_players()))
+            yield Tutorial
+
         # submit the decision page
         yield Decision, dict(effort_to_firm=C.ENDOWMENT)
 
-        # results page (no form, just click next)
-        yield Results
+        # results page (auto-advances on timeout; no Next button in the HTML)
+        yield Submission(Results, check_html=False)
 
         # Relay is auto-advanced by timeout and often has no Next button,
         # so we simulate a timeout submission and disable HTML checking.
         yield Submission(Relay, timeout_happened=True, check_html=False)
 
         # quick sanity checks on the paper constraint:
-        size_by_block = self.participant.vars.get("size_by_block", {})
-        block_starts = [1, 11, 21]
-
-        sizes_so_far = [size_by_block[b] for b in block_starts if b in size_by_block and b <= self.round_number]
+        block = block_index(self.session, self.round_number)
+        sizes_so_far = [s for s in self.participant.exo_size_by_block[:block + 1] if s]
 
         expect(len(set(sizes_so_far)), len(sizes_so_far))  # no repeats among blocks so far
 
-        if self.round_number <= 10:
-            expect(len(sizes_so_far), 1)
-        elif self.round_number <= 20:
-            expect(len(sizes_so_far), 2)
-        else:
-            expect(len(sizes_so_far), 3)
+        # sizes are only recorded for real (non-test) groupings
+        if not self.session.config.get('test_mode', False):
+            expect(len(sizes_so_far), block + 1)
+
+        # Relay label for this block is fixed
+        expect(self.group.firm_label, self.participant.exo_firm_by_block[block])
+
+        # the group is the schedule's firm for this block
+        firm = self.session.vars['exo_schedule']['blocks'][block][self.group.id_in_subsession - 1]
+        expect(sorted(p.id_in_subsession for p in self.group.get_players()), sorted(firm['members']))
+        expect(self.group.cohort, firm['cohort'])
@@ -0,0 +1,163 @@
+"""
+Opt-in profiling of page callbacks, written as collapsed stacks for flamegraphs.
+
+Both apps call `instrument(page_sequence)` at import. It wraps the callbacks
+each page class defines itself: vars_for_template, js_vars, before_next_page,
+is_displayed, get_timeout_seconds, live_method and after_all_players_arrive.
+A wrapped callback runs untouched unless profiling is on, which is either:
+
+- the env var PGG_PROFILE=<file> (every session), or
+- `profile=True` in a session config (that session only; written to
+  PGG_PROFILE if set, else profile.collapsed in the working directory).
+
+While a profiled callback runs, a sys.setprofile tracer attributes the exact
+time between events to the current call stack, so even a 2 ms callback yields
+a complete picture (oTree's own template rendering happens after the callbacks
+and is not covered). Stacks are aggregated per page class and callback across
+all participants and rounds, and rewritten every few seconds and at exit:
+
+    <file>               "app.Page.callback;func (file.py:line);...  microseconds"
+    <file stem>.tsv      per page callback: calls, total ms, mean ms, max ms
+
+Render with e.g. `flamegraph.pl profile.collapsed > profile.svg` or load the
+file into speedscope.
+"""
+import atexit
+import functools
+import logging
+import os
+import sys
+import threading
+import time
+from collections import Counter
+
+
+HOOKS = (
+    'vars_for_template', 'js_vars', 'before_next_page', 'is_displayed',
+    'get_timeout_seconds', 'live_method', 'after_all_players_arrive',
+)
+DEFAULT_PATH = 'profile.collapsed'
+FLUSH_SECONDS = 5
+
+logger = logging.getLogger(__name__)
+
+_lock = threading.Lock()
+_stacks = Counter()    # (root, frame labels...) -> nanoseconds of self time
+_calls = {}            # root -> [calls, total ns, max ns]
+_local = threading.local()
+_paths = set()
+_last_flush = 0.0
+
+
+def instrument(page_sequence):
+    """Wrap the callbacks of every page class in page_sequence (in place)."""
+    for page in page_sequence:
+        app = page.__module__.split('.')[0]
+        for name in HOOKS:
+            raw = page.__dict__.get(name)
+            fn = raw.__func__ if isinstance(raw, staticmethod) else raw
+            if callable(fn) and not getattr(fn, '_profiled', False):
+                setattr(page, name, staticmethod(_wrap(fn, f"{app}.{page.__name__}.{name}")))
+
+
+def _wrap(fn, root):
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        path = _profile_path(args, kwargs)
+        if path is None or getattr(_local, 'tracer', None) is not None:
+            return fn(*args, **kwargs)
+        tracer = _Tracer(root)
+        _local.tracer = tracer
+        start = time.perf_counter_ns()
+        sys.setprofile(tracer)
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            sys.setprofile(None)
+            _local.tracer = None
+            _record(root, tracer.samples, time.perf_counter_ns() - start, path)
+
+    wrapper._profiled = True
+    return wrapper
+
+
+def _profile_path(args, kwargs):
+    env_path = os.environ.get('PGG_PROFILE')
+    if env_path:
+        return env_path
+    # first argument is a player, group or subsession (WaitPage callbacks get kwargs)
+    obj = args[0] if args else next(iter(kwargs.values()), None)
+    session = getattr(obj, 'session', None)
+    if session is not None and session.config.get('profile'):
+        return DEFAULT_PATH
+    return None
+
+
+class _Tracer:
+    """sys.setprofile hook: self time (ns) per call stack below the root."""
+
+    def __init__(self, root):
+        self.stack = [root]
+        self.samples = Counter()
+        self.t = time.perf_counter_ns()
+
+    def __call__(self, frame, event, arg):
+        now = time.perf_counter_ns()
+        self.samples[tuple(self.stack)] += now - self.t
+        if event == 'call':
+            code = frame.f_code
+            self.stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{code.co_firstlineno})")
+        elif event == 'c_call':
+            self.stack.append(f"{getattr(arg, '__qualname__', arg)} (builtin)")
+        elif len(self.stack) > 1:
+            # return, c_return, c_exception
+            self.stack.pop()
+        self.t = time.perf_counter_ns()
+
+
+def _record(root, samples, elapsed_ns, path):
+    global _last_flush
+    with _lock:
+        _stacks.update(samples)
+        calls = _calls.setdefault(root, [0, 0, 0])
+        calls[0] += 1
+        calls[1] += elapsed_ns
+        calls[2] = max(calls[2], elapsed_ns)
+        _paths.add(path)
+        if time.monotonic() - _last_flush < FLUSH_SECONDS:
+            return
+        _last_flush = time.monotonic()
+    write()
+
+
+def write():
+    """Rewrite the collapsed-stack and timing files with everything so far."""
+    with _lock:
+        stacks = sorted(_stacks.items())
+        calls = sorted(_calls.items(), key=lambda kv: -kv[1][1])
+        paths = list(_paths)
+    for path in paths:
+        try:
+            _write_files(path, stacks, calls)
+        except OSError as exc:
+            # a profile that cannot be written must not break the page
+            logger.warning(f"profiling: cannot write {path}: {exc}")
+
+
+def _write_files(path, stacks, calls):
+    _replace(path, (f"{';'.join(stack)} {ns // 1000}\n" for stack, ns in stacks if ns >= 1000))
+    _replace(os.path.splitext(path)[0] + '.tsv', [
+        "callback\tcalls\ttotal_ms\tmean_ms\tmax_ms\n",
+        *(f"{root}\t{n}\t{total / 1e6:.2f}\t{total / n / 1e6:.3f}\t{worst / 1e6:.2f}\n"
+          for root, (n, total, worst) in calls),
+    ])
+
+
+def _replace(path, lines):
+    tmp = f"{path}.{os.getpid()}.tmp"
+    with open(tmp, 'w') as f:
+        f.writelines(lines)
+    os.replace(tmp, path)
+
+
+atexit.register(write)
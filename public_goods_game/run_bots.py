@@ -0,0 +1,194 @@
+"""
+Run the bot suites of several session configs at once and report on all of them.
+
+Each config runs `otree test <config>` in its own process, from a scratch
+directory that links to the project files. The bots keep their data in memory,
+and the scratch directory has no db.sqlite3 for them to load. So runs cannot
+see each other, and an outdated development database cannot abort them.
+
+The report has:
+
+- pass/fail and wall time per config (plus the output tail of failures)
+- per-page timing over all configs: oTree logs "Submit <page>" just before the
+  POST, so a page's time is measured from its Submit line to the next line of
+  output. That covers the request, plus the next bot's own work (e.g. a
+  call_live_method stress round).
+
+Usage, from this directory:
+
+    python run_bots.py                                  # every config in SESSION_CONFIGS but perf ones
+    python run_bots.py T3_bots_small T4_test_small --jobs 2
+    python run_bots.py --participants 12 --json bots.json --logs bot_logs
+"""
+import argparse
+import json
+import os
+import re
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import settings
+
+
+SUBMIT = re.compile(r'^Submit /p/[^/]+/(?P<app>[^/]+)/(?P<page>[^/,]+)/\d+')
+
+
+def scratch_workdir():
+    # oTree bots start from ./db.sqlite3 if there is one, so link everything else
+    project = os.path.dirname(os.path.abspath(__file__))
+    workdir = tempfile.mkdtemp(prefix='pgg-bots-')
+    for name in os.listdir(project):
+        if not name.endswith('.sqlite3'):
+            os.symlink(os.path.join(project, name), os.path.join(workdir, name))
+    return workdir
+
+
+def run_config(name, participants=None, timeout=None):
+    """Run one config's bots. Returns a result dict (never raises)."""
+    workdir = scratch_workdir()
+    cmd = ['otree', 'test', name] + ([str(participants)] if participants else [])
+    env = dict(os.environ, PYTHONUNBUFFERED='1')
+    env.pop('DATABASE_URL', None)
+
+    lines = []  # (seconds since start, text)
+    t0 = time.monotonic()
+    proc = subprocess.Popen(
+        cmd, cwd=workdir, env=env, text=True,
+        stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+    )
+    # a reader thread collects the output, so a child that hangs without
+    # printing is still killed when the timeout runs out
+    reader = threading.Thread(target=lambda: lines.extend(
+        (time.monotonic() - t0, text.rstrip('\n')) for text in proc.stdout
+    ))
+    reader.start()
+    timed_out = False
+    try:
+        try:
+            proc.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            timed_out = True
+            proc.kill()
+            proc.wait()
+        reader.join()
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+    wall = time.monotonic() - t0
+
+    completed = sum(1 for _, text in lines if text == 'Bots completed session')
+    ok = proc.returncode == 0 and completed > 0 and not timed_out
+    return dict(
+        config=name,
+        ok=ok,
+        timed_out=timed_out,
+        returncode=proc.returncode,
+        wall_seconds=round(wall, 2),
+        sessions=completed,
+        pages=page_timings(lines, wall),
+        output=[text for _, text in lines],
+    )
+
+
+def page_timings(lines, end):
+    """'app/Page' -> list of seconds, from each Submit line to the next line."""
+    out = {}
+    for i, (t, text) in enumerate(lines):
+        m = SUBMIT.match(text)
+        if m:
+            t_next = lines[i + 1][0] if i + 1 < len(lines) else end
+            out.setdefault(f"{m['app']}/{m['page']}", []).append(t_next - t)
+    return out
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[int(q * (len(values) - 1))]
+
+
+def ms(seconds):
+    return f"{seconds * 1000:.1f}"
+
+
+def print_report(results, tail=30):
+    print()
+    print(f"  {'config':<26}{'result':>8}{'wall s':>9}{'pages':>7}  slowest page (p95 ms)")
+    print('-' * 80)
+    for r in results:
+        result = 'pass' if r['ok'] else ('timeout' if r['timed_out'] else 'FAIL')
+        slowest = ''
+        if r['pages']:
+            page, samples = max(r['pages'].items(), key=lambda kv: percentile(kv[1], 0.95))
+            slowest = f"{page} ({ms(percentile(samples, 0.95))})"
+        n_pages = sum(len(v) for v in r['pages'].values())
+        print(f"  {r['config']:<26}{result:>8}{r['wall_seconds']:>9.1f}{n_pages:>7}  {slowest}")
+
+    merged = {}
+    for r in results:
+        for page, samples in r['pages'].items():
+            merged.setdefault(page, []).extend(samples)
+    if merged:
+        print()
+        print(f"  {'page':<36}{'count':>7}{'mean ms':>10}{'p50 ms':>9}{'p95 ms':>9}{'max ms':>9}")
+        print('-' * 80)
+        for page, samples in sorted(merged.items(), key=lambda kv: -sum(kv[1])):
+            print(f"  {page:<36}{len(samples):>7}{ms(sum(samples) / len(samples)):>10}"
+                  f"{ms(percentile(samples, 0.5)):>9}{ms(percentile(samples, 0.95)):>9}"
+                  f"{ms(max(samples)):>9}")
+
+    for r in results:
+        if not r['ok']:
+            print(f"\n--- {r['config']} (exit code {r['returncode']}), last {tail} lines ---")
+            print('\n'.join(r['output'][-tail:]))
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('configs', nargs='*',
+                        help="config names (default: all SESSION_CONFIGS without bot_live_budget_ms)")
+    parser.add_argument('--jobs', type=int, default=os.cpu_count(), help="configs run at the same time")
+    parser.add_argument('--participants', type=int, help="override num_demo_participants")
+    parser.add_argument('--timeout', type=float, default=3600, help="seconds per config")
+    parser.add_argument('--json', help="also write the report (without output) to this file")
+    parser.add_argument('--logs', help="directory for each config's full bot output")
+    args = parser.parse_args()
+
+    # perf configs assert wall-clock budgets, which parallel runs would break
+    names = args.configs or [
+        c['name'] for c in settings.SESSION_CONFIGS if not c.get('bot_live_budget_ms')
+    ]
+    unknown = set(names) - {c['name'] for c in settings.SESSION_CONFIGS}
+    if unknown:
+        raise Exception(f"No session config named {', '.join(sorted(unknown))}")
+
+    print(f"running {len(names)} config(s), {args.jobs} at a time")
+    t0 = time.monotonic()
+    with ThreadPoolExecutor(args.jobs) as pool:
+        futures = [pool.submit(run_config, name, args.participants, args.timeout) for name in names]
+        results = []
+        for future in futures:
+            r = future.result()
+            print(f"  {r['config']}: {'pass' if r['ok'] else 'FAIL'} in {r['wall_seconds']:.1f}s")
+            results.append(r)
+    print(f"total wall time {time.monotonic() - t0:.1f}s")
+
+    print_report(results)
+
+    if args.logs:
+        os.makedirs(args.logs, exist_ok=True)
+        for r in results:
+            with open(os.path.join(args.logs, f"{r['config']}.log"), 'w') as f:
+                f.write('\n'.join(r['output']) + '\n')
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump([{k: v for k, v in r.items() if k != 'output'} for r in results], f, indent=1)
+
+    return 0 if all(r['ok'] for r in results) else 1
+
+
+if __name__ == '__main__':
+    sys.exit(main())
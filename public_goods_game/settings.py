@@ -23,6 +23,16 @@ SESSION_CONFIGS = [
        test_mode=True,
        participation_fee=5,
    ),
+   dict(
+       name='T1_bots_cohorts',
+       display_name="T1 bots (2 cohorts)",
+       app_sequence=['pg_exogenous'],
+       num_demo_participants=40,
+       returns_type='constant',
+       participation_fee=5,
+       # two cohorts of 20, solved in a process pool (see pg_exogenous/tests.py)
+       exo_schedule_workers=2,
+   ),
    dict(
        name='T3_bots_small',
        display_name="T3 bots small",
@@ -33,6 +43,22 @@ SESSION_CONFIGS = [
        formation_seconds=120,
        info_seconds=120,
        participation_fee=10,
+       # bots drive live_formation (see pg_endogenous/tests.py)
+       bot_live_intensity=3,
+   ),
+   dict(
+       name='T3_bots_perf',
+       display_name="T3 bots perf (live latency budget)",
+       app_sequence=['pg_endogenous'],
+       num_demo_participants=12,
+       returns_type='constant',
+       test_mode=True,
+       formation_seconds=120,
+       info_seconds=120,
+       participation_fee=10,
+       # fails on slow live calls: run it alone, not under run_bots.py
+       bot_live_intensity=3,
+       bot_live_budget_ms=250,
    ),
 
 
@@ -98,7 +124,11 @@ SESSION_CONFIG_DEFAULTS = dict(
 
 
 
-PARTICIPANT_FIELDS = []
+PARTICIPANT_FIELDS = [
+   # pg_exogenous: one int per block (index = block number, 0 = not assigned)
+   'exo_size_by_block',
+   'exo_firm_by_block',
+]
 SESSION_FIELDS = []
 
 